@@ -1,45 +1,499 @@
+import atexit
+import contextvars
+import functools
+import heapq
+import hmac
+import inspect
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import random
 import re
-from datetime import datetime, timedelta
-from flask import Flask, request
+import sys
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
-    ContextTypes
+    ContextTypes,
+    TypeHandler
 )
 import sqlite3
 import asyncio
 import threading
 
-# --- Настройки ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# --- Логирование ---
+# Записи из потока Flask и из bot_loop только кладутся в очередь; форматирование в JSON
+# и запись в stderr идут в отдельном потоке слушателя, так что медленный вывод не тормозит апдейты.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SLOW_UPDATE_MS = float(os.getenv("LOG_SLOW_UPDATE_MS", "1000"))
+# Доля сохраняемых записей по уровням, например "DEBUG=0.01,INFO=0.2"; остальные уровни пишутся все
+LOG_SAMPLE_RATES = {
+    level.strip().upper(): float(rate)
+    for level, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(","))
+    if rate
+}
+LOG_FIELDS = ("bot", "update_id", "chat_id", "handler", "duration_ms")
+
+current_update = contextvars.ContextVar("current_update", default=None)  # (bot_id, update_id, chat_id)
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+
+class LogContextFilter(logging.Filter):
+    """Семплирует записи по уровню и добавляет к ним поля апдейта из контекста (в потоке вызова)."""
+
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(record.levelname)
+        if rate is not None and random.random() >= rate:
+            return False
+        record.bot, record.update_id, record.chat_id = current_update.get() or (None, None, None)
+        record.handler = current_handler.get()
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь без форматирования; при переполнении запись отбрасывается, а не ждёт."""
+
+    def prepare(self, record):
+        # Сообщение собирается из msg % args уже в потоке слушателя
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc_metric("log_dropped_total")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_handler = LogQueueHandler(log_queue)
+log_handler.addFilter(LogContextFilter())
+log_output = logging.StreamHandler()
+log_output.setFormatter(JsonFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, log_output)
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+log_listener.start()
+atexit.register(log_listener.stop)  # дописываем очередь при выходе
 logger = logging.getLogger(__name__)
 
+# --- Настройки ---
 DB_NAME = 'marriage_bot.db'
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-if not TOKEN:
-    raise ValueError("TELEGRAM_BOT_TOKEN не установлен!")
+
+
+def load_bot_tokens() -> dict:
+    """Боты процесса: BOT_TOKENS="main=токен,second=токен" или один TELEGRAM_BOT_TOKEN под именем main."""
+    tokens = {}
+    for item in os.getenv("BOT_TOKENS", "").split(","):
+        bot_id, _, token = item.strip().partition("=")
+        if bot_id and token:
+            tokens[bot_id.strip()] = token.strip()
+    if not tokens and os.getenv("TELEGRAM_BOT_TOKEN"):
+        tokens["main"] = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not tokens:
+        raise ValueError("Не задан ни BOT_TOKENS, ни TELEGRAM_BOT_TOKEN!")
+    return tokens
+
+
+BOT_TOKENS = load_bot_tokens()
+# Бот по умолчанию работает со старой базой и старым адресом /webhook
+DEFAULT_BOT_ID = "main" if "main" in BOT_TOKENS else next(iter(BOT_TOKENS))
 
 app = Flask(__name__)
 
 # --- Глобальные переменные ---
-telegram_app = None
+applications = {}  # bot_id -> Application; все живут в одном bot_loop
+current_bot = contextvars.ContextVar("current_bot", default=DEFAULT_BOT_ID)
 bot_loop = None
+bot_thread_id = None
+update_scheduler = None
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+MAX_BACKGROUND_TASKS = int(os.getenv("MAX_BACKGROUND_TASKS", "8"))
+
+# --- Метрики ---
+# Простые счётчики и значения, отдаются через /metrics в текстовом формате Prometheus.
+metrics = {}
+metrics_lock = threading.Lock()
+
+
+def set_metric(name: str, value):
+    with metrics_lock:
+        metrics[name] = value
+
+
+def inc_metric(name: str, amount=1):
+    with metrics_lock:
+        metrics[name] = metrics.get(name, 0) + amount
+
+
+# --- Трассировка ---
+# Доля трассируемых апдейтов (0 — выключено). Спаны пишутся в TRACE_FILE (JSONL)
+# или, если файл не задан, в кольцевой буфер в памяти. Файл пишет отдельный поток,
+# bot_loop только кладёт спан в очередь.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))
+TRACE_QUEUE_SIZE = 10000
+
+trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+trace_queue = queue.Queue(TRACE_QUEUE_SIZE)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attrs", "start", "started")
+
+    def __init__(self, name: str, trace_id, parent_id=None, **attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = time.time()
+        self.started = time.perf_counter()
+
+    def child(self, name: str, **attrs) -> "Span":
+        return Span(name, self.trace_id, self.span_id, **attrs)
+
+    def finish(self):
+        export_span({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "thread": threading.current_thread().name,
+            **self.attrs,
+        })
+
+
+def export_span(record: dict):
+    if TRACE_FILE:
+        try:
+            trace_queue.put_nowait(record)
+        except queue.Full:
+            inc_metric("trace_dropped_total")
+    else:
+        trace_buffer.append(record)
+
+
+def trace_writer():
+    """Пишет спаны из очереди в TRACE_FILE; файл открыт всё время, flush — когда очередь опустела."""
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        while True:
+            record = trace_queue.get()
+            if record is None:
+                f.flush()
+                return
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            if trace_queue.empty():
+                f.flush()
+
+
+def stop_trace_writer(thread: threading.Thread):
+    trace_queue.put(None)
+    thread.join(timeout=5)
+
+
+if TRACE_FILE:
+    trace_thread = threading.Thread(target=trace_writer, name="trace-writer", daemon=True)
+    trace_thread.start()
+    atexit.register(stop_trace_writer, trace_thread)  # дописываем очередь при выходе
+
+
+def start_trace(name: str, trace_id, **attrs):
+    """Открывает корневой спан, если апдейт попал в выборку, иначе возвращает None."""
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    return Span(name, trace_id, **attrs)
+
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = parent.child(name, **attrs)
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+
+def traced(kind: str):
+    """Оборачивает функцию (обычную или async) в дочерний спан «kind.имя»."""
+    def decorator(func):
+        name = f"{kind}.{func.__name__}"
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if kind == "handler":
+                    # Остаётся в контексте апдейта до конца: попадёт и в итоговую запись dispatch_update
+                    current_handler.set(func.__name__)
+                if current_span.get() is None:
+                    return await func(*args, **kwargs)
+                with trace_span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_span.get() is None:
+                return func(*args, **kwargs)
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracingRequest(HTTPXRequest):
+    """HTTP-клиент бота, записывающий каждый вызов Bot API как спан."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        if current_span.get() is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        with trace_span("bot_api." + url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+# --- Планировщик апдейтов ---
+class UpdateScheduler:
+    """Обрабатывает апдейты разных чатов параллельно (не больше max_concurrent одновременно),
+    а апдейты одного чата или одного пользователя — строго по очереди."""
+
+    def __init__(self, max_concurrent: int):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.locks = {}  # ключ -> [asyncio.Lock, сколько апдейтов держат или ждут ключ]
+
+    @staticmethod
+    def keys(update: Update) -> list:
+        keys = []
+        bot_id = current_bot.get()
+        if update.effective_chat:
+            keys.append(("chat", bot_id, update.effective_chat.id))
+        if update.effective_user:
+            keys.append(("user", bot_id, update.effective_user.id))
+        # Единый порядок захвата исключает взаимную блокировку
+        return sorted(keys)
+
+    async def run(self, update: Update, handler):
+        entries = []
+        for key in self.keys(update):
+            entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append((key, entry))
+
+        acquired = []
+        try:
+            with trace_span("scheduler.wait"):
+                for _, entry in entries:
+                    await entry[0].acquire()
+                    acquired.append(entry[0])
+            async with self.semaphore:
+                await handler(update)
+        finally:
+            for lock in acquired:
+                lock.release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+
+async def dispatch_update(bot_id: str, update: Update, root, queued):
+    # Всё, что ниже (хранилище, кэш карточек, лимиты), берёт данные этого бота
+    current_bot.set(bot_id)
+    current_update.set((bot_id, update.update_id, update.effective_chat.id if update.effective_chat else None))
+    application = applications[bot_id]
+    if profiler.active:
+        profiler.count_update()
+    started = time.perf_counter()
+    try:
+        if root is None:
+            return await update_scheduler.run(update, application.process_update)
+        queued.finish()
+        span = root.child("process_update")
+        token = current_span.set(span)
+        try:
+            await update_scheduler.run(update, application.process_update)
+        finally:
+            current_span.reset(token)
+            span.finish()
+            root.finish()
+    finally:
+        duration_ms = round((time.perf_counter() - started) * 1000, 3)
+        level = logging.WARNING if duration_ms >= LOG_SLOW_UPDATE_MS else logging.DEBUG
+        logger.log(level, "Апдейт обработан", extra={"duration_ms": duration_ms})
+
+# --- Фоновые задачи ---
+# Обработчик сразу отвечает пользователю (answer() на кнопку, заглушка на команду), а медленную
+# часть — запросы имён, сборку карточки, итоговый edit — отдаёт сюда и не держит блокировку чата.
+class BackgroundTasks:
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.tasks = set()  # сильные ссылки, иначе задачу может собрать GC
+
+    def spawn(self, coro) -> asyncio.Task:
+        # Задача наследует контекст апдейта: current_bot, поля логов, текущий спан.
+        # owner — обработчик, запустивший задачу: по нему профилировщик группирует её семплы.
+        task = asyncio.get_running_loop().create_task(self.run(coro, current_handler.get()))
+        self.tasks.add(task)
+        set_metric("background_tasks", len(self.tasks))
+        task.add_done_callback(self.done)
+        return task
+
+    def done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        set_metric("background_tasks", len(self.tasks))
+
+    async def run(self, coro, owner):
+        async with self.semaphore:
+            try:
+                await coro
+            except Exception:
+                inc_metric("background_failures_total")
+                logger.exception("Ошибка фоновой задачи")
+
+    async def drain(self, timeout: float):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+
+background = BackgroundTasks(MAX_BACKGROUND_TASKS)
+
+# --- Профилировщик ---
+# Семплирующий профилировщик потока bot_loop, включается на время через /profiler.
+# Стеки группируются по обработчику и пишутся в формате collapsed stacks (flamegraph.pl, speedscope).
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 600
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.thread = None
+        self.handler_codes = {}
+        self.stacks = {}
+        self.samples = 0
+        self.updates_left = None
+        self.deadline = 0
+        self.last_result = None
+
+    def start(self, seconds=None, updates=None) -> bool:
+        with self.lock:
+            if self.active or bot_thread_id is None or not applications:
+                return False
+            # Код обработчиков -> имя: по нему семпл относится к обработчику.
+            # Обработчики у всех ботов общие, достаточно первого приложения.
+            self.handler_codes = {}
+            for handlers in next(iter(applications.values())).handlers.values():
+                for handler in handlers:
+                    callback = inspect.unwrap(handler.callback)
+                    self.handler_codes[callback.__code__] = callback.__name__
+            self.stacks = {}
+            self.samples = 0
+            self.updates_left = updates
+            self.deadline = time.monotonic() + min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+            self.active = True
+            self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def count_update(self):
+        if self.updates_left is not None:
+            self.updates_left -= 1
+
+    def run(self):
+        started = datetime.now()
+        while time.monotonic() < self.deadline and (self.updates_left is None or self.updates_left > 0):
+            self.sample()
+            time.sleep(PROFILE_INTERVAL)
+        try:
+            self.last_result = self.write(started)
+            logger.info("🔬 Профилирование завершено: %s семплов, %s", self.samples, self.last_result)
+        finally:
+            # Снимаем active под lock и только после write(): иначе start() успеет подменить stacks
+            with self.lock:
+                self.active = False
+
+    def sample(self):
+        frame = sys._current_frames().get(bot_thread_id)
+        stack = []
+        group = "loop"
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            if code in self.handler_codes:
+                group = self.handler_codes[code]
+            elif code is BackgroundTasks.run.__code__:
+                # Фоновая задача: относим к обработчику, который её запустил
+                group = frame.f_locals.get("owner") or group
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        per_group = self.stacks.setdefault(group, {})
+        per_group[key] = per_group.get(key, 0) + 1
+        self.samples += 1
+
+    def write(self, started: datetime) -> str:
+        path = os.path.join(PROFILE_DIR, f"{started:%Y%m%d-%H%M%S}")
+        os.makedirs(path, exist_ok=True)
+        for group, stacks in self.stacks.items():
+            with open(os.path.join(path, f"{group}.folded"), "w", encoding="utf-8") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write(f"{stack} {count}\n")
+        return path
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "samples": self.samples,
+            "last_result": self.last_result,
+        }
+
+
+profiler = SamplingProfiler()
 
 # --- Экранирование для MarkdownV2 ---
 def escape_md(text: str) -> str:
     return re.sub(r'([_*\[\]()~`>#+\-=|{}.!\\])', r'\\\1', text)
 
 # --- Инициализация базы данных ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
+def init_db(path: str = None):
+    conn = sqlite3.connect(path or DB_NAME)
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -52,6 +506,9 @@ def init_db():
             budget INTEGER DEFAULT 0,
             last_daily TEXT,
             family_level INTEGER DEFAULT 1,
+            kids_count INTEGER DEFAULT 0,
+            score INTEGER DEFAULT 0,
+            max_level INTEGER DEFAULT 1,
             UNIQUE(user1, chat_id),
             UNIQUE(user2, chat_id),
             CHECK(user1 != user2)
@@ -66,7 +523,8 @@ def init_db():
             chat_id INTEGER,
             name TEXT,
             created_at TEXT DEFAULT (datetime('now')),
-            birthday TEXT DEFAULT (datetime('now', '+1 year'))
+            birthday TEXT DEFAULT (datetime('now', '+1 year')),
+            family_id INTEGER REFERENCES marriages(id)
         )
     ''')
 
@@ -86,7 +544,8 @@ def init_db():
             job TEXT DEFAULT 'Безработный',
             work_streak INTEGER DEFAULT 0,
             last_work TEXT,
-            total_works INTEGER DEFAULT 0
+            total_works INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT (datetime('now'))
         )
     ''')
 
@@ -114,16 +573,7 @@ def init_db():
 
     cursor.execute('SELECT COUNT(*) FROM shop_items')
     if cursor.fetchone()[0] == 0:
-        items = [
-            ('Кассир', 'job', 100, 'Работает в магазине'),
-            ('Повар', 'job', 200, 'Готовит еду'),
-            ('Учитель', 'job', 300, 'Учит детей'),
-            ('Программист', 'job', 500, 'Пишет код'),
-            ('Блогер', 'job', 400, 'Снимает видео'),
-            ('Кольцо', 'gift', 150, 'Подарок супругу'),
-            ('Дом', 'upgrade', 1000, 'Даёт пассивный доход +20 за ход'),
-        ]
-        cursor.executemany('INSERT INTO shop_items (name, type, price, description) VALUES (?, ?, ?, ?)', items)
+        cursor.executemany('INSERT INTO shop_items (name, type, price, description) VALUES (?, ?, ?, ?)', SHOP_ITEMS)
 
     # Проверка колонок
     cursor.execute("PRAGMA table_info(children)")
@@ -131,129 +581,340 @@ def init_db():
     if 'birthday' not in cols:
         cursor.execute("ALTER TABLE children ADD COLUMN birthday TEXT DEFAULT (datetime('now', '+1 year'))")
 
+    cursor.execute("PRAGMA table_info(users)")
+    if 'created_at' not in [c[1] for c in cursor.fetchall()]:
+        # Для очистки пользователей без /work; у старых записей отсчёт начинается с миграции
+        cursor.execute("ALTER TABLE users ADD COLUMN created_at TEXT")
+        cursor.execute("UPDATE users SET created_at = datetime('now')")
+
     cursor.execute("PRAGMA table_info(marriages)")
     cols = [c[1] for c in cursor.fetchall()]
     if 'family_level' not in cols:
         cursor.execute("ALTER TABLE marriages ADD COLUMN family_level INTEGER DEFAULT 1")
+        cols.append('family_level')
+    if 'id' not in cols:
+        # Старая схема без id: пересобираем таблицу, чтобы у семьи был стабильный family_id
+        cursor.execute("ALTER TABLE marriages RENAME TO marriages_old")
+        cursor.execute('''
+            CREATE TABLE marriages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user1 INTEGER NOT NULL,
+                user2 INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                married_at TEXT DEFAULT (datetime('now')),
+                budget INTEGER DEFAULT 0,
+                last_daily TEXT,
+                family_level INTEGER DEFAULT 1,
+                UNIQUE(user1, chat_id),
+                UNIQUE(user2, chat_id),
+                CHECK(user1 != user2)
+            )
+        ''')
+        cursor.execute('''
+            INSERT OR IGNORE INTO marriages (user1, user2, chat_id, married_at, budget, last_daily, family_level)
+            SELECT user1, user2, chat_id, married_at, budget, last_daily, family_level FROM marriages_old
+        ''')
+        old_count = cursor.execute("SELECT COUNT(*) FROM marriages_old").fetchone()[0]
+        dropped = old_count - cursor.execute("SELECT COUNT(*) FROM marriages").fetchone()[0]
+        if dropped:
+            # Строки, нарушившие NOT NULL, CHECK или UNIQUE новой схемы, не теряем вместе с бюджетом:
+            # оставляем их в marriages_rejected для ручного разбора
+            cursor.execute('''
+                DELETE FROM marriages_old WHERE EXISTS (
+                    SELECT 1 FROM marriages m
+                    WHERE m.user1 = marriages_old.user1 AND m.user2 = marriages_old.user2
+                      AND m.chat_id = marriages_old.chat_id
+                )
+            ''')
+            cursor.execute("ALTER TABLE marriages_old RENAME TO marriages_rejected")
+            logger.error("Пересборка marriages: %s из %s строк не прошли ограничения, они в marriages_rejected",
+                         dropped, old_count)
+        else:
+            cursor.execute("DROP TABLE marriages_old")
 
-    conn.commit()
-    conn.close()
+    cursor.execute("PRAGMA table_info(children)")
+    cols = [c[1] for c in cursor.fetchall()]
+    if 'family_id' not in cols:
+        cursor.execute("ALTER TABLE children ADD COLUMN family_id INTEGER REFERENCES marriages(id)")
+        cursor.execute('''
+            UPDATE children SET family_id = (
+                SELECT m.id FROM marriages m
+                WHERE m.chat_id = children.chat_id
+                  AND ((m.user1 = children.parent1 AND m.user2 = children.parent2)
+                    OR (m.user1 = children.parent2 AND m.user2 = children.parent1))
+            )
+        ''')
 
-# --- Получить имя пользователя ---
-async def get_name(update: Update, user_id: int) -> str:
-    try:
-        user = await update.get_bot().get_chat(user_id)
-        return user.full_name or user.username or f"Пользователь {user_id}"
-    except:
-        return f"Пользователь {user_id}"
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_children_family ON children(family_id)")
 
-# --- Проверка брака ---
-def is_married(user_id: int, chat_id: int) -> tuple:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT user1, user2, married_at, budget, last_daily, family_level FROM marriages
-        WHERE (user1 = ? OR user2 = ?) AND chat_id = ?
-    ''', (user_id, user_id, chat_id))
-    row = cursor.fetchone()
-    conn.close()
-    return row
+    # Материализованные счётчики семьи: детей, очки и уровень поддерживаются триггерами.
+    # family_level — текущий уровень (может упасть после трат), max_level — наивысший достигнутый:
+    # повышение объявляется, только когда растёт max_level
+    cursor.execute("PRAGMA table_info(marriages)")
+    cols = [c[1] for c in cursor.fetchall()]
+    backfill = 'kids_count' not in cols
+    if 'kids_count' not in cols:
+        cursor.execute("ALTER TABLE marriages ADD COLUMN kids_count INTEGER DEFAULT 0")
+    if 'score' not in cols:
+        cursor.execute("ALTER TABLE marriages ADD COLUMN score INTEGER DEFAULT 0")
+    backfill_max_level = 'max_level' not in cols
+    if backfill_max_level:
+        cursor.execute("ALTER TABLE marriages ADD COLUMN max_level INTEGER DEFAULT 1")
+
+    level_case = "CASE " + " ".join(
+        f"WHEN NEW.budget + NEW.kids_count * {KID_SCORE} >= {threshold} THEN {i + 1}"
+        for i, (threshold, _) in reversed(list(enumerate(FAMILY_LEVELS)))
+    ) + " ELSE 1 END"
+    cursor.executescript(f'''
+        DROP TRIGGER IF EXISTS children_family_insert;
+        DROP TRIGGER IF EXISTS children_family_delete;
+        DROP TRIGGER IF EXISTS marriages_family_score;
+
+        CREATE TRIGGER children_family_insert AFTER INSERT ON children
+        WHEN NEW.family_id IS NOT NULL
+        BEGIN
+            UPDATE marriages SET kids_count = kids_count + 1 WHERE id = NEW.family_id;
+        END;
+
+        CREATE TRIGGER children_family_delete AFTER DELETE ON children
+        WHEN OLD.family_id IS NOT NULL
+        BEGIN
+            UPDATE marriages SET kids_count = kids_count - 1 WHERE id = OLD.family_id;
+        END;
+
+        CREATE TRIGGER marriages_family_score AFTER UPDATE OF budget, kids_count ON marriages
+        BEGIN
+            UPDATE marriages SET
+                score = NEW.budget + NEW.kids_count * {KID_SCORE},
+                family_level = {level_case},
+                max_level = MAX(NEW.max_level, {level_case})
+            WHERE id = NEW.id;
+        END;
+    ''')
 
-# --- Регистрация брака ---
-def register_marriage(user1: int, user2: int, chat_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    try:
-        cursor.execute('DELETE FROM marriages WHERE user1 = ? OR user2 = ?', (user1, user1))
-        cursor.execute('DELETE FROM marriages WHERE user1 = ? OR user2 = ?', (user2, user2))
+    if backfill:
         cursor.execute('''
-            INSERT INTO marriages (user1, user2, chat_id, married_at, budget, last_daily, family_level)
-            VALUES (?, ?, ?, datetime('now'), 0, NULL, 1)
-        ''', (user1, user2, chat_id))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при регистрации брака: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+            UPDATE marriages SET kids_count = (
+                SELECT COUNT(*) FROM children WHERE children.family_id = marriages.id
+            )
+        ''')
+    if backfill_max_level:
+        # Раньше family_level хранил наивысший уровень: переносим его в max_level,
+        # а текущий уровень пересчитает триггер (kids_count = kids_count его запускает)
+        cursor.execute("UPDATE marriages SET max_level = family_level, kids_count = kids_count")
 
-# --- Расторжение брака ---
-def divorce(user_id: int, chat_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM marriages WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
-    conn.commit()
-    conn.close()
+    # Архивные таблицы для очистки (см. run_retention)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS children_archive (
+            id INTEGER PRIMARY KEY,
+            parent1 INTEGER,
+            parent2 INTEGER,
+            chat_id INTEGER,
+            name TEXT,
+            created_at TEXT,
+            birthday TEXT,
+            family_id INTEGER,
+            archived_at TEXT DEFAULT (datetime('now'))
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users_archive (
+            user_id INTEGER,
+            chat_id INTEGER,
+            job TEXT,
+            work_streak INTEGER,
+            last_work TEXT,
+            total_works INTEGER,
+            archived_at TEXT DEFAULT (datetime('now'))
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS quests_archive (
+            user_id INTEGER,
+            chat_id INTEGER,
+            quest_type TEXT,
+            target INTEGER,
+            progress INTEGER,
+            completed INTEGER,
+            archived_at TEXT DEFAULT (datetime('now'))
+        )
+    ''')
 
-# --- Обновить бюджет семьи ---
-def update_family_budget(user_id: int, chat_id: int, amount: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    # Открытые достижения (см. ACHIEVEMENTS); раньше они вычислялись при каждом /profile
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'achievements'")
+    achievements_exist = cursor.fetchone() is not None
     cursor.execute('''
-        UPDATE marriages SET budget = budget + ?
-        WHERE (user1 = ? OR user2 = ?) AND chat_id = ?
-    ''', (amount, user_id, user_id, chat_id))
-    conn.commit()
-    conn.close()
+        CREATE TABLE IF NOT EXISTS achievements (
+            user_id INTEGER,
+            chat_id INTEGER,
+            code TEXT,
+            unlocked_at TEXT DEFAULT (datetime('now')),
+            PRIMARY KEY (user_id, chat_id, code)
+        )
+    ''')
+    if not achievements_exist:
+        # Разовый перенос: открываем то, что уже заработано по старым правилам
+        for code, condition in (
+            ("anniversary", "married_at <= datetime('now', '-365 days')"),
+            ("first_child", "kids_count >= 1"),
+            ("big_family", "kids_count >= 3"),
+            ("rich", "budget >= 1000"),
+        ):
+            for spouse in ("user1", "user2"):
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO achievements (user_id, chat_id, code)
+                    SELECT {spouse}, chat_id, ? FROM marriages WHERE {condition}
+                ''', (code,))
+        for code, quest_type in (("hard_worker", "work_5_times"), ("financier", "earn_500"), ("parent", "have_child")):
+            cursor.execute('''
+                INSERT OR IGNORE INTO achievements (user_id, chat_id, code)
+                SELECT user_id, chat_id, ? FROM quests WHERE quest_type = ? AND completed = 1
+            ''', (code, quest_type))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievements_archive (
+            user_id INTEGER,
+            chat_id INTEGER,
+            code TEXT,
+            unlocked_at TEXT,
+            archived_at TEXT DEFAULT (datetime('now'))
+        )
+    ''')
 
-# --- Получить бюджет ---
-def get_family_budget(user_id: int, chat_id: int) -> int:
-    marriage = is_married(user_id, chat_id)
-    return marriage[3] if marriage else 0
+    # Отметка принятых апдейтов бота (см. UpdateDeduplicator); в таблице одна строка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS update_mark (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            update_id INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            pending TEXT NOT NULL DEFAULT '[]'
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(update_mark)")
+    if 'pending' not in [c[1] for c in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE update_mark ADD COLUMN pending TEXT NOT NULL DEFAULT '[]'")
 
-# --- Можно ли предложить брак ---
-def can_propose(user_id: int, chat_id: int) -> bool:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT timestamp FROM proposals WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-    row = cursor.fetchone()
-    conn.close()
-    if not row:
-        return True
-    last = datetime.fromisoformat(row[0])
-    return datetime.now() - last > timedelta(seconds=300)
+    # Журнал движения бюджета (только добавление) и дневные сводки по нему
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            family_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TEXT DEFAULT (datetime('now'))
+        );
+
+        CREATE TABLE IF NOT EXISTS ledger_daily (
+            family_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            credit INTEGER DEFAULT 0,
+            debit INTEGER DEFAULT 0,
+            entries INTEGER DEFAULT 0,
+            PRIMARY KEY (family_id, day, reason)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_ledger_daily_chat ON ledger_daily(chat_id, day);
+
+        CREATE TRIGGER IF NOT EXISTS ledger_rollup AFTER INSERT ON ledger
+        BEGIN
+            INSERT INTO ledger_daily (family_id, chat_id, day, reason, credit, debit, entries)
+            VALUES (NEW.family_id, NEW.chat_id, date(NEW.created_at), NEW.reason,
+                    MAX(NEW.amount, 0), MAX(-NEW.amount, 0), 1)
+            ON CONFLICT(family_id, day, reason) DO UPDATE SET
+                credit = credit + excluded.credit,
+                debit = debit + excluded.debit,
+                entries = entries + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger is append-only');
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger is append-only');
+        END;
+    ''')
 
-# --- Обновить время предложения ---
-def update_proposal_time(user_id: int, chat_id: int):
-    now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO proposals (user_id, chat_id, timestamp)
-        VALUES (?, ?, ?)
-    ''', (user_id, chat_id, now))
     conn.commit()
-    conn.close()
 
-# --- Количество детей ---
-def count_children(user_id: int, chat_id: int) -> int:
-    marriage = is_married(user_id, chat_id)
-    if not marriage:
-        return 0
-    u1, u2 = marriage[0], marriage[1]
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT COUNT(*) FROM children
-        WHERE ((parent1 = ? AND parent2 = ?) OR (parent1 = ? AND parent2 = ?)) AND chat_id = ?
-    ''', (u1, u2, u2, u1, chat_id))
-    return cursor.fetchone()[0]
-
-# --- Получить детей ---
-def get_children(user_id: int, chat_id: int):
-    marriage = is_married(user_id, chat_id)
-    if not marriage:
-        return []
-    u1, u2 = marriage[0], marriage[1]
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT name, created_at, birthday FROM children
-        WHERE ((parent1 = ? AND parent2 = ?) OR (parent1 = ? AND parent2 = ?)) AND chat_id = ?
-    ''', (u1, u2, u2, u1, chat_id))
-    rows = cursor.fetchall()
+    # Режим incremental vacuum включается один раз и требует полного VACUUM
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] != 2:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+
     conn.close()
-    return rows
+
+# --- Кэш карточек /profile и /quests ---
+# Готовый текст карточки по ключу (вид, chat_id, user_id). Кэш живёт в bot_loop,
+# записи сбрасываются при любом изменении данных и в момент expires, если карточка зависит
+# от времени (счётчик «Вместе N дней» растёт во время суток, когда пара поженилась, а не в полночь).
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "2048"))
+CARD_VIEWS = ("profile", "quests")
+card_cache = OrderedDict()
+
+
+def get_card(view: str, chat_id: int, user_id: int):
+    key = (current_bot.get(), view, chat_id, user_id)
+    entry = card_cache.get(key)
+    if entry is None:
+        return None
+    expires, text = entry
+    if expires is not None and datetime.now() >= expires:
+        card_cache.pop(key, None)
+        return None
+    if not isinstance(text, str):
+        return None  # карточка ещё собирается (см. reserve_card)
+    card_cache.move_to_end(key)
+    return text
+
+
+def reserve_card(view: str, chat_id: int, user_id: int):
+    """Ставит отметку «карточка собирается» и возвращает её. invalidate_cards снимает отметку,
+    и тогда put_card с этой отметкой ничего не кэширует: данные успели измениться."""
+    reservation = object()
+    put_card(view, chat_id, user_id, reservation)
+    return reservation
+
+
+def put_card(view: str, chat_id: int, user_id: int, text, reservation=None, expires: datetime = None):
+    key = (current_bot.get(), view, chat_id, user_id)
+    if reservation is not None:
+        entry = card_cache.get(key)
+        if entry is None or entry[1] is not reservation:
+            return
+    card_cache[key] = (expires, text)
+    card_cache.move_to_end(key)
+    while len(card_cache) > CARD_CACHE_SIZE:
+        card_cache.popitem(last=False)
+
+
+def invalidate_cards(chat_id: int, *user_ids: int):
+    for user_id in user_ids:
+        for view in CARD_VIEWS:
+            card_cache.pop((current_bot.get(), view, chat_id, user_id), None)
+
+
+def invalidate_bot_cards():
+    bot_id = current_bot.get()
+    for key in [key for key in card_cache if key[0] == bot_id]:
+        del card_cache[key]
+
+# --- Получить имя пользователя ---
+async def get_name(update: Update, user_id: int) -> str:
+    # Автор апдейта уже есть в самом апдейте — без лишнего запроса к Bot API
+    if update.effective_user and update.effective_user.id == user_id and update.effective_user.full_name:
+        return update.effective_user.full_name
+    try:
+        user = await update.get_bot().get_chat(user_id)
+        return user.full_name or user.username or f"Пользователь {user_id}"
+    except:
+        return f"Пользователь {user_id}"
 
 # --- Уровни семьи ---
 FAMILY_LEVELS = [
@@ -264,69 +925,24 @@ FAMILY_LEVELS = [
     (5000, "👑 Аристократы")
 ]
 
-def get_family_level(budget: int, kids: int) -> tuple:
-    score = budget + kids * 200
+KID_SCORE = 200
+
+def family_level_for_score(score: int) -> int:
     level = 1
-    title = "🌱 Новички"
-    for i, (threshold, name) in enumerate(FAMILY_LEVELS):
+    for i, (threshold, _) in enumerate(FAMILY_LEVELS):
         if score >= threshold:
             level = i + 1
-            title = name
-    return level, title
-
-def update_family_level(user_id: int, chat_id: int) -> tuple:
-    budget = get_family_budget(user_id, chat_id)
-    kids = count_children(user_id, chat_id)
-    new_level, title = get_family_level(budget, kids)
+    return level
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT family_level FROM marriages WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
-    row = cursor.fetchone()
-    old_level = row[0] if row else 1
+def family_level_title(level: int) -> str:
+    return FAMILY_LEVELS[min(max(level, 1), len(FAMILY_LEVELS)) - 1][1]
 
-    if new_level > old_level:
-        cursor.execute('UPDATE marriages SET family_level = ? WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (new_level, user_id, user_id, chat_id))
-        conn.commit()
-        conn.close()
-        return new_level, title, True
-    conn.close()
-    return new_level, title, False
-
-# --- Достижения ---
-def get_achievements(user_id: int, chat_id: int) -> list:
-    ach = []
-    marriage = is_married(user_id, chat_id)
-    if not marriage:
-        return ["🌟 Начни с /marry!"]
-
-    days = (datetime.now() - datetime.fromisoformat(marriage[2])).days
-    kids = count_children(user_id, chat_id)
-    budget = get_family_budget(user_id, chat_id)
-
-    if days >= 365:
-        ach.append("🎖️ Годовщина: вместе больше года!")
-    if kids >= 1:
-        ach.append("👶 Первая семья: у вас есть ребёнок!")
-    if kids >= 3:
-        ach.append("👨‍👩‍👧‍👦 Многодетная семья: 3+ детей!")
-    if budget >= 1000:
-        ach.append("🏦 Богачи: бюджет ≥ 1000 монет")
-
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT quest_type FROM quests WHERE user_id = ? AND chat_id = ? AND completed = 1', (user_id, chat_id))
-    completed = [row[0] for row in cursor.fetchall()]
-    conn.close()
-
-    if 'work_5_times' in completed:
-        ach.append("👷‍♂️ Трудяга: завершил квест 'Работать 5 раз'")
-    if 'earn_500' in completed:
-        ach.append("💰 Финансист: заработал 500 монет")
-    if 'have_child' in completed:
-        ach.append("❤️ Родитель: завёл ребёнка")
-
-    return ach or ["💞 Молодожёны"]
+def level_up_text(result) -> str:
+    """Текст к изменению бюджета или детей: повышение уровня и открытые достижения."""
+    if not result:
+        return ""
+    text = f"\n🎉 Повышен до уровня {result[0]}: {result[1]}!" if result[2] else ""
+    return text + achievements_text(result[3])
 
 # --- РАБОТА И КВЕСТЫ ---
 JOBS = ["Безработный", "Кассир", "Повар", "Учитель", "Программист", "Блогер"]
@@ -343,121 +959,1162 @@ QUESTS_INFO = {
     "be_married_30_days": {"desc": "Быть в браке 30 дней", "target": 30, "reward": 400}
 }
 
-def get_user(user_id: int, chat_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT job, work_streak, last_work, total_works FROM users WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-    row = cursor.fetchone()
-    conn.close()
-    return row
+# --- Достижения ---
+# Каждое правило привязано к событию и проверяется только при нём:
+# child_born (kids), budget_changed (budget), quest_completed (quest), anniversary (days).
+# Порядок словаря — порядок вывода в /profile.
+ACHIEVEMENTS = {
+    "anniversary": {"title": "🎖️ Годовщина: вместе больше года!", "event": "anniversary",
+                    "check": lambda f: f["days"] >= 365},
+    "first_child": {"title": "👶 Первая семья: у вас есть ребёнок!", "event": "child_born",
+                    "check": lambda f: f["kids"] >= 1},
+    "big_family": {"title": "👨‍👩‍👧‍👦 Многодетная семья: 3+ детей!", "event": "child_born",
+                   "check": lambda f: f["kids"] >= 3},
+    "rich": {"title": "🏦 Богачи: бюджет ≥ 1000 монет", "event": "budget_changed",
+             "check": lambda f: f["budget"] >= 1000},
+    "hard_worker": {"title": "👷‍♂️ Трудяга: завершил квест 'Работать 5 раз'", "event": "quest_completed",
+                    "check": lambda f: f["quest"] == "work_5_times"},
+    "financier": {"title": "💰 Финансист: заработал 500 монет", "event": "quest_completed",
+                  "check": lambda f: f["quest"] == "earn_500"},
+    "parent": {"title": "❤️ Родитель: завёл ребёнка", "event": "quest_completed",
+               "check": lambda f: f["quest"] == "have_child"},
+}
+ACHIEVEMENT_RULES = {}  # событие -> коды достижений
+for code, rule in ACHIEVEMENTS.items():
+    ACHIEVEMENT_RULES.setdefault(rule["event"], []).append(code)
 
-def create_user(user_id: int, chat_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, chat_id, job, work_streak, last_work, total_works)
-        VALUES (?, ?, 'Безработный', 0, NULL, 0)
-    ''', (user_id, chat_id))
-    conn.commit()
-    conn.close()
 
-def update_job(user_id: int, chat_id: int, job: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET job = ? WHERE user_id = ? AND chat_id = ?', (job, user_id, chat_id))
-    conn.commit()
-    conn.close()
+def achievements_for(event: str, **facts) -> list:
+    """Коды достижений, условия которых выполнены при событии event."""
+    return [code for code in ACHIEVEMENT_RULES.get(event, ()) if ACHIEVEMENTS[code]["check"](facts)]
 
-def update_work_stats(user_id: int, chat_id: int, streak: int, total: int):
-    now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+
+def achievements_text(codes) -> str:
+    return "".join(f"\n🏅 Новое достижение: {ACHIEVEMENTS[code]['title']}" for code in codes)
+
+
+def check_anniversary(marriage: tuple, chat_id: int) -> list:
+    """Событие «годовщина»: у него нет записи в базе, поэтому проверяется при /daily и /profile."""
+    days = (datetime.now() - datetime.fromisoformat(marriage[2])).days
+    codes = achievements_for("anniversary", days=days)
+    return storage.unlock_achievements(marriage[:2], chat_id, codes) if codes else []
+
+
+def achievement_titles(codes: list, marriage) -> list:
+    titles = [rule["title"] for code, rule in ACHIEVEMENTS.items() if code in codes]
+    if titles:
+        return titles
+    return ["💞 Молодожёны"] if marriage else ["🌟 Начни с /marry!"]
+
+# Причины движения бюджета в журнале
+LEDGER_REASONS = {
+    "salary": "💼 Зарплата",
+    "passive": "🏠 Пассивный доход",
+    "quest": "🏆 Квесты",
+    "daily": "🎁 Ежедневный бонус",
+    "casino": "🎲 Казино",
+    "purchase": "🛒 Покупки",
+    "child": "👶 Дети",
+    "gift": "💍 Подарки",
+}
+HISTORY_DAYS = 7
+
+SHOP_ITEMS = [
+    ('Кассир', 'job', 100, 'Работает в магазине'),
+    ('Повар', 'job', 200, 'Готовит еду'),
+    ('Учитель', 'job', 300, 'Учит детей'),
+    ('Программист', 'job', 500, 'Пишет код'),
+    ('Блогер', 'job', 400, 'Снимает видео'),
+    ('Кольцо', 'gift', 150, 'Подарок супругу'),
+    ('Дом', 'upgrade', 1000, 'Даёт пассивный доход +20 за ход'),
+]
+
+PROPOSAL_COOLDOWN = timedelta(seconds=300)
+
+# --- Хранилище ---
+class Storage:
+    """Интерфейс хранилища игровых данных. Обработчики работают только через него.
+
+    Брак возвращается кортежем (user1, user2, married_at, budget, last_daily,
+    family_level, family_id, kids_count); изменения бюджета и детей возвращают
+    (уровень, название, повышен ли уровень, коды открытых достижений).
+    """
+
+    def init(self):
+        pass
+
+    # Браки
+    def is_married(self, user_id: int, chat_id: int) -> tuple:
+        raise NotImplementedError
+
+    def register_marriage(self, user1: int, user2: int, chat_id: int):
+        raise NotImplementedError
+
+    def divorce(self, user_id: int, chat_id: int):
+        raise NotImplementedError
+
+    def update_family_budget(self, user_id: int, chat_id: int, amount: int, reason: str):
+        """Меняет бюджет и в той же транзакции пишет запись в журнал с причиной из LEDGER_REASONS."""
+        raise NotImplementedError
+
+    def set_last_daily(self, user_id: int, chat_id: int):
+        raise NotImplementedError
+
+    def get_family_budget(self, user_id: int, chat_id: int) -> int:
+        marriage = self.is_married(user_id, chat_id)
+        return marriage[3] if marriage else 0
+
+    # Журнал бюджета (читаются только дневные сводки)
+    def get_history(self, user_id: int, chat_id: int, days: int) -> list:
+        """[(день, причина, приход, расход)] семьи за последние days дней, новые дни первыми."""
+        raise NotImplementedError
+
+    def get_chat_economy(self, chat_id: int, days: int) -> list:
+        """[(причина, приход, расход, операций)] по всем семьям чата за последние days дней."""
+        raise NotImplementedError
+
+    # Предложения
+    def can_propose(self, user_id: int, chat_id: int) -> bool:
+        raise NotImplementedError
+
+    def update_proposal_time(self, user_id: int, chat_id: int):
+        raise NotImplementedError
+
+    # Дети
+    def count_children(self, user_id: int, chat_id: int) -> int:
+        raise NotImplementedError
+
+    def get_children(self, user_id: int, chat_id: int) -> list:
+        raise NotImplementedError
+
+    def add_child(self, marriage: tuple, chat_id: int, name: str):
+        raise NotImplementedError
+
+    # Пользователи
+    def get_user(self, user_id: int, chat_id: int):
+        raise NotImplementedError
+
+    def create_user(self, user_id: int, chat_id: int):
+        raise NotImplementedError
+
+    def update_job(self, user_id: int, chat_id: int, job: str):
+        raise NotImplementedError
+
+    def update_work_stats(self, user_id: int, chat_id: int, streak: int, total: int):
+        raise NotImplementedError
+
+    def reset_user(self, user_id: int, chat_id: int):
+        raise NotImplementedError
+
+    # Квесты
+    def get_quest(self, user_id: int, chat_id: int, quest_type: str):
+        raise NotImplementedError
+
+    def get_quests(self, user_id: int, chat_id: int) -> list:
+        raise NotImplementedError
+
+    def create_quest(self, user_id: int, chat_id: int, quest_type: str):
+        raise NotImplementedError
+
+    def update_quest_progress(self, user_id: int, chat_id: int, quest_type: str, progress: int):
+        raise NotImplementedError
+
+    def complete_quest_db(self, user_id: int, chat_id: int, quest_type: str) -> list:
+        """Закрывает квест; возвращает коды открытых им достижений."""
+        raise NotImplementedError
+
+    # Достижения
+    def get_achievements(self, user_id: int, chat_id: int) -> list:
+        raise NotImplementedError
+
+    def unlock_achievements(self, user_ids, chat_id: int, codes: list) -> list:
+        """Открывает достижения пользователям; возвращает коды, открытые впервые."""
+        raise NotImplementedError
+
+    # Магазин
+    def get_shop(self) -> list:
+        raise NotImplementedError
+
+    def buy_item(self, user_id: int, chat_id: int, item_name: str) -> bool:
+        item = next((i for i in self.get_shop() if i[0] == item_name), None)
+        if not item:
+            return False
+        _, item_type, price, _ = item
+
+        if self.get_family_budget(user_id, chat_id) < price:
+            return False
+
+        self.update_family_budget(user_id, chat_id, -price, "purchase")
+        if item_type == 'job':
+            self.update_job(user_id, chat_id, item_name)
+        return True
+
+    # Отметка апдейтов: (update_id, time.time(), pending) или None. Все id <= update_id приняты,
+    # pending — принятые id выше неё (дыры из-за доставки не по порядку).
+    def get_update_mark(self) -> tuple:
+        raise NotImplementedError
+
+    def set_update_mark(self, update_id: int, pending: list):
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path: str = None):
+        self.path = path
+
+    def connect(self):
+        return sqlite3.connect(self.path or DB_NAME)
+
+    def init(self):
+        init_db(self.path)
+
+    # --- Проверка брака ---
+    @traced("db")
+    def is_married(self, user_id: int, chat_id: int) -> tuple:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user1, user2, married_at, budget, last_daily, family_level, id, kids_count FROM marriages
+            WHERE (user1 = ? OR user2 = ?) AND chat_id = ?
+        ''', (user_id, user_id, chat_id))
+        row = cursor.fetchone()
+        conn.close()
+        return row
+
+    # --- Регистрация брака ---
+    @traced("db")
+    def register_marriage(self, user1: int, user2: int, chat_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('DELETE FROM marriages WHERE user1 = ? OR user2 = ?', (user1, user1))
+            cursor.execute('DELETE FROM marriages WHERE user1 = ? OR user2 = ?', (user2, user2))
+            cursor.execute('''
+                INSERT INTO marriages (user1, user2, chat_id, married_at, budget, last_daily, family_level)
+                VALUES (?, ?, ?, datetime('now'), 0, NULL, 1)
+            ''', (user1, user2, chat_id))
+            conn.commit()
+        except Exception as e:
+            logger.error("Ошибка при регистрации брака: %s", e)
+            conn.rollback()
+        finally:
+            conn.close()
+
+    # --- Расторжение брака ---
+    @traced("db")
+    def divorce(self, user_id: int, chat_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM marriages WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
+        conn.commit()
+        conn.close()
+
+    # --- Обновить бюджет семьи ---
+    @traced("db")
+    def update_family_budget(self, user_id: int, chat_id: int, amount: int, reason: str):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT id, max_level, user1, user2 FROM marriages
+                WHERE (user1 = ? OR user2 = ?) AND chat_id = ?
+            ''', (user_id, user_id, chat_id))
+            row = cursor.fetchone()
+            if not row:
+                conn.rollback()
+                return None
+            family_id, old_max, u1, u2 = row
+            cursor.execute('UPDATE marriages SET budget = budget + ? WHERE id = ?', (amount, family_id))
+            cursor.execute('''
+                INSERT INTO ledger (family_id, chat_id, user_id, amount, reason)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (family_id, chat_id, user_id, amount, reason))
+            cursor.execute('SELECT family_level, max_level, budget FROM marriages WHERE id = ?', (family_id,))
+            new_level, new_max, budget = cursor.fetchone()
+            unlocked = []
+            if amount > 0:
+                unlocked = self.insert_achievements(cursor, (u1, u2), chat_id, achievements_for("budget_changed", budget=budget))
+            conn.commit()
+        finally:
+            conn.close()
+        return new_level, family_level_title(new_level), new_max > old_max, unlocked
+
+    @traced("db")
+    def set_last_daily(self, user_id: int, chat_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE marriages SET last_daily = datetime("now") WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
+        conn.commit()
+        conn.close()
+
+    # --- Журнал бюджета ---
+    @traced("db")
+    def get_history(self, user_id: int, chat_id: int, days: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT day, reason, credit, debit FROM ledger_daily
+            WHERE family_id = ({self.FAMILY_ID_SUBQUERY}) AND day >= date('now', ?)
+            ORDER BY day DESC, reason
+        ''', (user_id, user_id, chat_id, f'-{days - 1} days'))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    @traced("db")
+    def get_chat_economy(self, chat_id: int, days: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT reason, SUM(credit), SUM(debit), SUM(entries) FROM ledger_daily
+            WHERE chat_id = ? AND day >= date('now', ?)
+            GROUP BY reason ORDER BY reason
+        ''', (chat_id, f'-{days - 1} days'))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    # --- Можно ли предложить брак ---
+    @traced("db")
+    def can_propose(self, user_id: int, chat_id: int) -> bool:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT timestamp FROM proposals WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return True
+        last = datetime.fromisoformat(row[0])
+        return datetime.now() - last > PROPOSAL_COOLDOWN
+
+    # --- Обновить время предложения ---
+    @traced("db")
+    def update_proposal_time(self, user_id: int, chat_id: int):
+        now = datetime.now().isoformat()
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO proposals (user_id, chat_id, timestamp)
+            VALUES (?, ?, ?)
+        ''', (user_id, chat_id, now))
+        conn.commit()
+        conn.close()
+
+    # --- Количество детей ---
+    FAMILY_ID_SUBQUERY = 'SELECT id FROM marriages WHERE (user1 = ? OR user2 = ?) AND chat_id = ?'
+
+    @traced("db")
+    def count_children(self, user_id: int, chat_id: int) -> int:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM children
+            WHERE family_id = ({self.FAMILY_ID_SUBQUERY})
+        ''', (user_id, user_id, chat_id))
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    # --- Получить детей ---
+    @traced("db")
+    def get_children(self, user_id: int, chat_id: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT name, created_at, birthday FROM children
+            WHERE family_id = ({self.FAMILY_ID_SUBQUERY})
+        ''', (user_id, user_id, chat_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    # --- Добавить ребёнка ---
+    @traced("db")
+    def add_child(self, marriage: tuple, chat_id: int, name: str):
+        u1, u2, family_id = marriage[0], marriage[1], marriage[6]
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT max_level FROM marriages WHERE id = ?', (family_id,))
+            old_max = cursor.fetchone()[0]
+            cursor.execute('''
+                INSERT INTO children (parent1, parent2, chat_id, name, family_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (u1, u2, chat_id, name, family_id))
+            cursor.execute('SELECT family_level, max_level, kids_count FROM marriages WHERE id = ?', (family_id,))
+            new_level, new_max, kids = cursor.fetchone()
+            unlocked = self.insert_achievements(cursor, (u1, u2), chat_id, achievements_for("child_born", kids=kids))
+            conn.commit()
+        finally:
+            conn.close()
+        return new_level, family_level_title(new_level), new_max > old_max, unlocked
+
+    # --- Пользователи ---
+    @traced("db")
+    def get_user(self, user_id: int, chat_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT job, work_streak, last_work, total_works FROM users WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+        row = cursor.fetchone()
+        conn.close()
+        return row
+
+    @traced("db")
+    def create_user(self, user_id: int, chat_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (user_id, chat_id, job, work_streak, last_work, total_works, created_at)
+            VALUES (?, ?, 'Безработный', 0, NULL, 0, datetime('now'))
+        ''', (user_id, chat_id))
+        conn.commit()
+        conn.close()
+
+    @traced("db")
+    def update_job(self, user_id: int, chat_id: int, job: str):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET job = ? WHERE user_id = ? AND chat_id = ?', (job, user_id, chat_id))
+        conn.commit()
+        conn.close()
+
+    @traced("db")
+    def update_work_stats(self, user_id: int, chat_id: int, streak: int, total: int):
+        now = datetime.now().isoformat()
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users SET work_streak = ?, total_works = ?, last_work = ?
+            WHERE user_id = ? AND chat_id = ?
+        ''', (streak, total, now, user_id, chat_id))
+        conn.commit()
+        conn.close()
+
+    @traced("db")
+    def reset_user(self, user_id: int, chat_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('DELETE FROM marriages WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
+            cursor.execute('DELETE FROM users WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+            cursor.execute('DELETE FROM quests WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+            cursor.execute('DELETE FROM achievements WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+            conn.commit()
+        except Exception as e:
+            logger.error("Ошибка при сбросе пользователя %s: %s", user_id, e)
+            conn.rollback()
+        finally:
+            conn.close()
+
+    # --- Квесты ---
+    @traced("db")
+    def get_quest(self, user_id: int, chat_id: int, quest_type: str):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT progress, completed FROM quests WHERE user_id = ? AND chat_id = ? AND quest_type = ?', (user_id, chat_id, quest_type))
+        row = cursor.fetchone()
+        conn.close()
+        return row
+
+    @traced("db")
+    def get_quests(self, user_id: int, chat_id: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT quest_type, progress, completed, target FROM quests WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    @traced("db")
+    def create_quest(self, user_id: int, chat_id: int, quest_type: str):
+        quest = QUESTS_INFO.get(quest_type)
+        if not quest:
+            return
+        target = quest["target"]
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO quests (user_id, chat_id, quest_type, target, progress, completed)
+            VALUES (?, ?, ?, ?, 0, 0)
+        ''', (user_id, chat_id, quest_type, target))
+        conn.commit()
+        conn.close()
+
+    @traced("db")
+    def update_quest_progress(self, user_id: int, chat_id: int, quest_type: str, progress: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE quests SET progress = ? WHERE user_id = ? AND chat_id = ? AND quest_type = ?', (progress, user_id, chat_id, quest_type))
+        conn.commit()
+        conn.close()
+
+    @traced("db")
+    def complete_quest_db(self, user_id: int, chat_id: int, quest_type: str) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE quests SET completed = 1, progress = target WHERE user_id = ? AND chat_id = ? AND quest_type = ?', (user_id, chat_id, quest_type))
+        unlocked = self.insert_achievements(cursor, (user_id,), chat_id, achievements_for("quest_completed", quest=quest_type))
+        conn.commit()
+        conn.close()
+        return unlocked
+
+    # --- Достижения ---
+    @staticmethod
+    def insert_achievements(cursor, user_ids, chat_id: int, codes: list) -> list:
+        """Записывает достижения в текущей транзакции; возвращает коды, которых ещё не было."""
+        unlocked = []
+        for code in codes:
+            for user_id in user_ids:
+                cursor.execute('INSERT OR IGNORE INTO achievements (user_id, chat_id, code) VALUES (?, ?, ?)', (user_id, chat_id, code))
+                if cursor.rowcount > 0 and code not in unlocked:
+                    unlocked.append(code)
+        return unlocked
+
+    @traced("db")
+    def get_achievements(self, user_id: int, chat_id: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT code FROM achievements WHERE user_id = ? AND chat_id = ? ORDER BY unlocked_at', (user_id, chat_id))
+        codes = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return codes
+
+    @traced("db")
+    def unlock_achievements(self, user_ids, chat_id: int, codes: list) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        unlocked = self.insert_achievements(cursor, user_ids, chat_id, codes)
+        conn.commit()
+        conn.close()
+        return unlocked
+
+    # --- Магазин ---
+    @traced("db")
+    def get_shop(self) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, type, price, description FROM shop_items')
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    @traced("db")
+    def buy_item(self, user_id: int, chat_id: int, item_name: str) -> bool:
+        return super().buy_item(user_id, chat_id, item_name)
+
+    # --- Отметка апдейтов ---
+    def get_update_mark(self) -> tuple:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT update_id, updated_at, pending FROM update_mark WHERE id = 1')
+        row = cursor.fetchone()
+        conn.close()
+        return (row[0], row[1], json.loads(row[2])) if row else None
+
+    def set_update_mark(self, update_id: int, pending: list):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO update_mark (id, update_id, updated_at, pending) VALUES (1, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                update_id = excluded.update_id, updated_at = excluded.updated_at, pending = excluded.pending
+        ''', (update_id, time.time(), json.dumps(pending)))
+        conn.commit()
+        conn.close()
+
+
+def sql_now() -> str:
+    """Текущее время в формате datetime('now') SQLite (UTC)."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def one_year_later(moment: datetime) -> datetime:
+    """Как модификатор '+1 year' в SQLite: 29 февраля переходит в 1 марта."""
+    try:
+        return moment.replace(year=moment.year + 1)
+    except ValueError:
+        return moment.replace(year=moment.year + 1, month=3, day=1)
+
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса с той же семантикой, что и SQLite-схема. Для тестов и бенчмарков."""
+
+    def __init__(self):
+        self.marriages = {}       # family_id -> dict
+        self.spouses = {}         # (user_id, chat_id) -> family_id
+        self.children = {}        # family_id -> [(name, created_at, birthday)]
+        self.proposals = {}       # (user_id, chat_id) -> isoformat
+        self.users = {}           # user_id -> dict (как PRIMARY KEY в таблице users)
+        self.quests = {}          # (user_id, chat_id, quest_type) -> [target, progress, completed]
+        self.ledger = []          # (family_id, chat_id, user_id, amount, reason, created_at)
+        self.ledger_daily = {}    # (family_id, day, reason) -> [chat_id, credit, debit, entries]
+        self.shop = list(SHOP_ITEMS)
+        self.achievements = {}    # (user_id, chat_id) -> {code: unlocked_at}
+        self.update_mark = None   # (update_id, updated_at, pending)
+        self.next_family_id = 1
+
+    def marriage_tuple(self, family: dict) -> tuple:
+        return (family['user1'], family['user2'], family['married_at'], family['budget'],
+                family['last_daily'], family['family_level'], family['id'], family['kids_count'])
+
+    def family(self, user_id: int, chat_id: int):
+        family_id = self.spouses.get((user_id, chat_id))
+        return self.marriages.get(family_id) if family_id else None
+
+    def drop_family(self, family: dict):
+        del self.marriages[family['id']]
+        self.spouses.pop((family['user1'], family['chat_id']), None)
+        self.spouses.pop((family['user2'], family['chat_id']), None)
+
+    def recalc_level(self, family: dict) -> tuple:
+        old_max = family['max_level']
+        score = family['budget'] + family['kids_count'] * KID_SCORE
+        new_level = family['family_level'] = family_level_for_score(score)
+        family['max_level'] = max(old_max, new_level)
+        return new_level, family_level_title(new_level), family['max_level'] > old_max
+
+    def is_married(self, user_id: int, chat_id: int) -> tuple:
+        family = self.family(user_id, chat_id)
+        return self.marriage_tuple(family) if family else None
+
+    def register_marriage(self, user1: int, user2: int, chat_id: int):
+        for family in [f for f in self.marriages.values()
+                       if {f['user1'], f['user2']} & {user1, user2}]:
+            self.drop_family(family)
+        family_id = self.next_family_id
+        self.next_family_id += 1
+        self.marriages[family_id] = {
+            'id': family_id, 'user1': user1, 'user2': user2, 'chat_id': chat_id,
+            'married_at': sql_now(), 'budget': 0, 'last_daily': None,
+            'family_level': 1, 'kids_count': 0, 'max_level': 1,
+        }
+        self.spouses[(user1, chat_id)] = family_id
+        self.spouses[(user2, chat_id)] = family_id
+
+    def divorce(self, user_id: int, chat_id: int):
+        family = self.family(user_id, chat_id)
+        if family:
+            self.drop_family(family)
+
+    def update_family_budget(self, user_id: int, chat_id: int, amount: int, reason: str):
+        family = self.family(user_id, chat_id)
+        if not family:
+            return None
+        family['budget'] += amount
+        created_at = sql_now()
+        self.ledger.append((family['id'], chat_id, user_id, amount, reason, created_at))
+        rollup = self.ledger_daily.setdefault((family['id'], created_at[:10], reason), [chat_id, 0, 0, 0])
+        rollup[1] += max(amount, 0)
+        rollup[2] += max(-amount, 0)
+        rollup[3] += 1
+        unlocked = []
+        if amount > 0:
+            unlocked = self.unlock_achievements((family['user1'], family['user2']), chat_id,
+                                                achievements_for("budget_changed", budget=family['budget']))
+        return (*self.recalc_level(family), unlocked)
+
+    def history_since(self, days: int) -> str:
+        return (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+
+    def get_history(self, user_id: int, chat_id: int, days: int) -> list:
+        family_id = self.spouses.get((user_id, chat_id))
+        since = self.history_since(days)
+        rows = [(day, reason, credit, debit)
+                for (fid, day, reason), (_, credit, debit, _) in self.ledger_daily.items()
+                if fid == family_id and day >= since]
+        rows.sort(key=lambda r: r[1])
+        rows.sort(key=lambda r: r[0], reverse=True)
+        return rows
+
+    def get_chat_economy(self, chat_id: int, days: int) -> list:
+        since = self.history_since(days)
+        totals = {}
+        for (_, day, reason), (rollup_chat, credit, debit, entries) in self.ledger_daily.items():
+            if rollup_chat == chat_id and day >= since:
+                total = totals.setdefault(reason, [0, 0, 0])
+                total[0] += credit
+                total[1] += debit
+                total[2] += entries
+        return [(reason, *totals[reason]) for reason in sorted(totals)]
+
+    def set_last_daily(self, user_id: int, chat_id: int):
+        family = self.family(user_id, chat_id)
+        if family:
+            family['last_daily'] = sql_now()
+
+    def can_propose(self, user_id: int, chat_id: int) -> bool:
+        last = self.proposals.get((user_id, chat_id))
+        if not last:
+            return True
+        return datetime.now() - datetime.fromisoformat(last) > PROPOSAL_COOLDOWN
+
+    def update_proposal_time(self, user_id: int, chat_id: int):
+        self.proposals[(user_id, chat_id)] = datetime.now().isoformat()
+
+    def count_children(self, user_id: int, chat_id: int) -> int:
+        family_id = self.spouses.get((user_id, chat_id))
+        return len(self.children.get(family_id, ()))
+
+    def get_children(self, user_id: int, chat_id: int) -> list:
+        family_id = self.spouses.get((user_id, chat_id))
+        return list(self.children.get(family_id, ()))
+
+    def add_child(self, marriage: tuple, chat_id: int, name: str):
+        family = self.marriages[marriage[6]]
+        born = datetime.now(timezone.utc)
+        self.children.setdefault(family['id'], []).append((
+            name, born.strftime('%Y-%m-%d %H:%M:%S'),
+            one_year_later(born).strftime('%Y-%m-%d %H:%M:%S'),
+        ))
+        family['kids_count'] += 1
+        unlocked = self.unlock_achievements((family['user1'], family['user2']), chat_id,
+                                            achievements_for("child_born", kids=family['kids_count']))
+        return (*self.recalc_level(family), unlocked)
+
+    def get_user(self, user_id: int, chat_id: int):
+        user = self.users.get(user_id)
+        if not user or user['chat_id'] != chat_id:
+            return None
+        return user['job'], user['work_streak'], user['last_work'], user['total_works']
+
+    def create_user(self, user_id: int, chat_id: int):
+        self.users.setdefault(user_id, {
+            'chat_id': chat_id, 'job': 'Безработный', 'work_streak': 0, 'last_work': None, 'total_works': 0,
+        })
+
+    def update_job(self, user_id: int, chat_id: int, job: str):
+        user = self.users.get(user_id)
+        if user and user['chat_id'] == chat_id:
+            user['job'] = job
+
+    def update_work_stats(self, user_id: int, chat_id: int, streak: int, total: int):
+        user = self.users.get(user_id)
+        if user and user['chat_id'] == chat_id:
+            user.update(work_streak=streak, total_works=total, last_work=datetime.now().isoformat())
+
+    def reset_user(self, user_id: int, chat_id: int):
+        self.divorce(user_id, chat_id)
+        user = self.users.get(user_id)
+        if user and user['chat_id'] == chat_id:
+            del self.users[user_id]
+        for key in [k for k in self.quests if k[0] == user_id and k[1] == chat_id]:
+            del self.quests[key]
+        self.achievements.pop((user_id, chat_id), None)
+
+    def get_quest(self, user_id: int, chat_id: int, quest_type: str):
+        quest = self.quests.get((user_id, chat_id, quest_type))
+        return (quest[1], quest[2]) if quest else None
+
+    def get_quests(self, user_id: int, chat_id: int) -> list:
+        return [(key[2], progress, completed, target)
+                for key, (target, progress, completed) in sorted(self.quests.items())
+                if key[0] == user_id and key[1] == chat_id]
+
+    def create_quest(self, user_id: int, chat_id: int, quest_type: str):
+        quest = QUESTS_INFO.get(quest_type)
+        key = (user_id, chat_id, quest_type)
+        if not quest or key in self.quests:
+            return
+        self.quests[key] = [quest["target"], 0, 0]
+
+    def update_quest_progress(self, user_id: int, chat_id: int, quest_type: str, progress: int):
+        quest = self.quests.get((user_id, chat_id, quest_type))
+        if quest:
+            quest[1] = progress
+
+    def complete_quest_db(self, user_id: int, chat_id: int, quest_type: str) -> list:
+        quest = self.quests.get((user_id, chat_id, quest_type))
+        if not quest:
+            return []
+        quest[1], quest[2] = quest[0], 1
+        return self.unlock_achievements((user_id,), chat_id, achievements_for("quest_completed", quest=quest_type))
+
+    def get_achievements(self, user_id: int, chat_id: int) -> list:
+        return list(self.achievements.get((user_id, chat_id), ()))
+
+    def unlock_achievements(self, user_ids, chat_id: int, codes: list) -> list:
+        unlocked = []
+        for code in codes:
+            for user_id in user_ids:
+                owned = self.achievements.setdefault((user_id, chat_id), {})
+                if code not in owned:
+                    owned[code] = sql_now()
+                    if code not in unlocked:
+                        unlocked.append(code)
+        return unlocked
+
+    def get_shop(self) -> list:
+        return list(self.shop)
+
+    def get_update_mark(self) -> tuple:
+        return self.update_mark
+
+    def set_update_mark(self, update_id: int, pending: list):
+        self.update_mark = (update_id, time.time(), list(pending))
+
+
+STORAGE_BACKENDS = {"sqlite": SQLiteStorage, "memory": MemoryStorage}
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+
+def bot_db_path(bot_id: str) -> str:
+    """У каждого бота своя база; бот по умолчанию остаётся в DB_NAME."""
+    if bot_id == DEFAULT_BOT_ID:
+        return DB_NAME
+    stem, ext = os.path.splitext(DB_NAME)
+    return f"{stem}_{bot_id}{ext}"
+
+
+def make_storage(bot_id: str) -> Storage:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(bot_db_path(bot_id))
+    return STORAGE_BACKENDS[STORAGE_BACKEND]()
+
+
+# Изменяющие методы Storage и чьи карточки они делают устаревшими:
+# "user" — пользователя, "family" — пользователя и его супруга в чате, "child" — родителей из кортежа брака,
+# "achievements" — перечисленных пользователей, если что-то открыто впервые,
+# "bot" — браки пользователей удаляются во всех чатах, поэтому сбрасываются все карточки бота
+CARD_CHANGES = {
+    "register_marriage": "bot",
+    "divorce": "family",
+    "reset_user": "family",
+    "update_family_budget": "family",
+    "buy_item": "family",
+    "add_child": "child",
+    "unlock_achievements": "achievements",
+    "update_job": "user",
+    "update_work_stats": "user",
+    "create_quest": "user",
+    "update_quest_progress": "user",
+    "complete_quest_db": "user",
+}
+
+
+class BotStorage:
+    """Хранилище текущего бота (по current_bot); остальной код обращается к нему как к обычному Storage.
+    Кэш карточек сбрасывается только здесь, после изменяющих методов из CARD_CHANGES:
+    бэкенды о кэше ничего не знают."""
+
+    def __getattr__(self, name):
+        backend = storages[current_bot.get()]
+        scope = CARD_CHANGES.get(name)
+        if scope is None:
+            return getattr(backend, name)
+        return functools.partial(self.call_and_invalidate, backend, name, scope)
+
+    @staticmethod
+    def call_and_invalidate(backend, name, scope, *args):
+        users = ()
+        if scope == "family" and card_cache:
+            # Супруга ищем до вызова: развод и сброс удаляют брак. При пустом кэше сбрасывать нечего
+            marriage = backend.is_married(args[0], args[1])
+            users = marriage[:2] if marriage else args[:1]
+        elif scope == "child":
+            users = args[0][:2]
+        elif scope == "achievements":
+            users = args[0]
+        elif scope == "user":
+            users = args[:1]
+        result = getattr(backend, name)(*args)
+        if scope == "bot":
+            invalidate_bot_cards()
+        elif scope != "achievements" or result:
+            invalidate_cards(args[1], *users)
+        return result
+
+
+storages = {bot_id: make_storage(bot_id) for bot_id in BOT_TOKENS}
+storage = BotStorage()
+
+# --- Очистка и архивирование ---
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "24"))
+RETENTION_USER_DAYS = int(os.getenv("RETENTION_USER_DAYS", "365"))
+RETENTION_BATCH_SIZE = 500
+RETENTION_PAUSE = 0.05  # пауза между пачками, чтобы не задерживать живые записи
+VACUUM_STEP_PAGES = 256
+
+
+def run_in_batches(step, on_commit=None) -> int:
+    """Вызывает step(cursor) в отдельных коротких транзакциях, пока он возвращает полную пачку.
+    on_commit() вызывается после коммита каждой пачки."""
+    total = 0
+    while True:
+        conn = storage.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            moved = step(cursor)
+            conn.commit()
+            if on_commit:
+                on_commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        total += moved
+        if moved < RETENTION_BATCH_SIZE:
+            return total
+        time.sleep(RETENTION_PAUSE)
+
+
+def archive_orphaned_children(cursor) -> int:
+    cursor.execute('''
+        SELECT id FROM children
+        WHERE family_id IS NULL OR NOT EXISTS (SELECT 1 FROM marriages m WHERE m.id = children.family_id)
+        LIMIT ?
+    ''', (RETENTION_BATCH_SIZE,))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholders = ",".join("?" * len(ids))
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO children_archive (id, parent1, parent2, chat_id, name, created_at, birthday, family_id)
+        SELECT id, parent1, parent2, chat_id, name, created_at, birthday, family_id FROM children
+        WHERE id IN ({placeholders})
+    ''', ids)
+    cursor.execute(f'DELETE FROM children WHERE id IN ({placeholders})', ids)
+    return len(ids)
+
+
+def archive_stale_users(cursor, cutoff: str, archived: list) -> int:
+    # Кто ни разу не работал, устаревает по дате создания записи
     cursor.execute('''
-        UPDATE users SET work_streak = ?, total_works = ?, last_work = ?
+        SELECT user_id, chat_id FROM users u
+        WHERE COALESCE(last_work, created_at) < ?
+          AND NOT EXISTS (
+              SELECT 1 FROM marriages m
+              WHERE m.chat_id = u.chat_id AND (m.user1 = u.user_id OR m.user2 = u.user_id)
+          )
+        LIMIT ?
+    ''', (cutoff, RETENTION_BATCH_SIZE))
+    stale = cursor.fetchall()
+    cursor.executemany('''
+        INSERT INTO users_archive (user_id, chat_id, job, work_streak, last_work, total_works)
+        SELECT user_id, chat_id, job, work_streak, last_work, total_works FROM users
         WHERE user_id = ? AND chat_id = ?
-    ''', (streak, total, now, user_id, chat_id))
-    conn.commit()
-    conn.close()
+    ''', stale)
+    cursor.executemany('''
+        INSERT INTO quests_archive (user_id, chat_id, quest_type, target, progress, completed)
+        SELECT user_id, chat_id, quest_type, target, progress, completed FROM quests
+        WHERE user_id = ? AND chat_id = ?
+    ''', stale)
+    cursor.executemany('''
+        INSERT INTO achievements_archive (user_id, chat_id, code, unlocked_at)
+        SELECT user_id, chat_id, code, unlocked_at FROM achievements
+        WHERE user_id = ? AND chat_id = ?
+    ''', stale)
+    cursor.executemany('DELETE FROM quests WHERE user_id = ? AND chat_id = ?', stale)
+    cursor.executemany('DELETE FROM achievements WHERE user_id = ? AND chat_id = ?', stale)
+    cursor.executemany('DELETE FROM users WHERE user_id = ? AND chat_id = ?', stale)
+    archived.extend(stale)
+    return len(stale)
 
-def get_quest(user_id: int, chat_id: int, quest_type: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT progress, completed FROM quests WHERE user_id = ? AND chat_id = ? AND quest_type = ?', (user_id, chat_id, quest_type))
-    row = cursor.fetchone()
-    conn.close()
-    return row
 
-def create_quest(user_id: int, chat_id: int, quest_type: str):
-    quest = QUESTS_INFO.get(quest_type)
-    if not quest:
-        return
-    target = quest["target"]
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO quests (user_id, chat_id, quest_type, target, progress, completed)
-        VALUES (?, ?, ?, ?, 0, 0)
-    ''', (user_id, chat_id, quest_type, target))
-    conn.commit()
-    conn.close()
+def invalidate_archived_users(archived: list):
+    """Сбрасывает карточки после коммита пачки: раньше /profile успел бы закэшировать ещё не удалённые данные."""
+    if bot_loop:
+        # call_soon_threadsafe копирует контекст, так что current_bot доходит до invalidate_cards
+        for user_id, chat_id in archived:
+            bot_loop.call_soon_threadsafe(invalidate_cards, chat_id, user_id)
+    archived.clear()
 
-def update_quest_progress(user_id: int, chat_id: int, quest_type: str, progress: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE quests SET progress = ? WHERE user_id = ? AND chat_id = ? AND quest_type = ?', (progress, user_id, chat_id, quest_type))
-    conn.commit()
-    conn.close()
 
-def complete_quest_db(user_id: int, chat_id: int, quest_type: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE quests SET completed = 1, progress = target WHERE user_id = ? AND chat_id = ? AND quest_type = ?', (user_id, chat_id, quest_type))
-    conn.commit()
-    conn.close()
+def delete_expired_proposals(cursor, cutoff: str) -> int:
+    cursor.execute('''
+        DELETE FROM proposals WHERE rowid IN (
+            SELECT rowid FROM proposals WHERE timestamp < ? LIMIT ?
+        )
+    ''', (cutoff, RETENTION_BATCH_SIZE))
+    return cursor.rowcount
 
-def get_shop():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT name, type, price, description FROM shop_items')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
 
-def buy_item(user_id: int, chat_id: int, item_name: str) -> bool:
-    conn = sqlite3.connect(DB_NAME)
+def incremental_vacuum() -> int:
+    """Освобождает свободные страницы небольшими шагами; возвращает число освобождённых байт."""
+    conn = storage.connect()
     cursor = conn.cursor()
-    cursor.execute('SELECT price, type FROM shop_items WHERE name = ?', (item_name,))
-    row = cursor.fetchone()
-    if not row:
+    try:
+        page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+        start = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        remaining = start
+        while remaining > 0:
+            cursor.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+            left = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            if left >= remaining:
+                break
+            remaining = left
+            time.sleep(RETENTION_PAUSE)
+        return (start - remaining) * page_size
+    finally:
         conn.close()
-        return False
-    price, item_type = row
 
-    budget = get_family_budget(user_id, chat_id)
-    if budget < price:
-        conn.close()
-        return False
 
-    update_family_budget(user_id, chat_id, -price)
-    if item_type == 'job':
-        update_job(user_id, chat_id, item_name)
-    conn.close()
-    return True
+def run_retention() -> dict:
+    now = datetime.now()
+    archived = []
+    stats = {
+        "children": run_in_batches(archive_orphaned_children),
+        "users": run_in_batches(
+            lambda c: archive_stale_users(c, (now - timedelta(days=RETENTION_USER_DAYS)).isoformat(), archived),
+            lambda: invalidate_archived_users(archived),
+        ),
+        "proposals": run_in_batches(lambda c: delete_expired_proposals(c, (now - PROPOSAL_COOLDOWN).isoformat())),
+    }
+    stats["reclaimed_bytes"] = incremental_vacuum()
+    logger.info(
+        "🧹 Очистка [%s]: детей в архиве %s, пользователей в архиве %s, предложений удалено %s, освобождено %s КБ",
+        current_bot.get(), stats["children"], stats["users"], stats["proposals"], stats["reclaimed_bytes"] // 1024,
+    )
+    return stats
 
-def reset_user(user_id: int, chat_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+
+def sqlite_bots() -> list:
+    return [bot_id for bot_id, backend in storages.items() if isinstance(backend, SQLiteStorage)]
+
+
+def retention_worker():
+    while True:
+        for bot_id in sqlite_bots():
+            current_bot.set(bot_id)
+            try:
+                run_retention()
+            except Exception as e:
+                logger.error("Ошибка очистки базы [%s]: %s", bot_id, e)
+        time.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+# --- Резервные копии ---
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_PAUSE = 0.01  # между шагами писатели получают доступ к базе
+BACKUP_MAX_RESTARTS = 3  # после стольких перезапусков порционной копии копируем за один шаг
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def backup_prefix(bot_id: str) -> str:
+    return os.path.splitext(os.path.basename(bot_db_path(bot_id)))[0] + "-"
+
+
+def backup_name_re(bot_id: str):
+    # Имя целиком: префикс бота a не должен совпадать со снимками бота a-b
+    return re.compile(re.escape(backup_prefix(bot_id)) + r"\d{8}-\d{6}\.db")
+
+
+def list_backups(bot_id: str = None) -> list:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    pattern = backup_name_re(bot_id or current_bot.get())
+    names = sorted(n for n in os.listdir(BACKUP_DIR) if pattern.fullmatch(n))
+    return [os.path.join(BACKUP_DIR, n) for n in names]
+
+
+def check_integrity(path: str) -> bool:
+    conn = sqlite3.connect(path)
     try:
-        cursor.execute('DELETE FROM marriages WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
-        cursor.execute('DELETE FROM users WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-        cursor.execute('DELETE FROM quests WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при сбросе пользователя {user_id}: {e}")
-        conn.rollback()
+        return conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
     finally:
         conn.close()
 
+
+def copy_database(src, dst, bot_id: str):
+    """Копирует базу порциями страниц с паузами. Если между шагами в базу пишет другое соединение,
+    SQLite начинает копию заново; на занятой базе это может длиться бесконечно, поэтому после
+    BACKUP_MAX_RESTARTS перезапусков копируем за один шаг (писатели ждут его на busy timeout)."""
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        # Без перезапуска remaining строго убывает с каждым шагом
+        if last_remaining is not None and remaining >= last_remaining:
+            restarts += 1
+            if restarts >= BACKUP_MAX_RESTARTS:
+                raise BackupRestarted
+        last_remaining = remaining
+        # sleep= в backup() действует только при BUSY/LOCKED, паузу между шагами делаем сами
+        time.sleep(BACKUP_STEP_PAUSE)
+
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+    except BackupRestarted:
+        inc_metric(f'backup_fallback_total{{bot="{bot_id}"}}')
+        logger.warning("Копия базы [%s] перезапускалась %s раз, копирую за один шаг", bot_id, restarts)
+        src.backup(dst)
+
+
+def make_backup() -> str:
+    """Онлайн-копия через SQLite backup API небольшими порциями страниц, с проверкой целостности и ротацией."""
+    bot_id = current_bot.get()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_DIR, f"{backup_prefix(bot_id)}{datetime.now():%Y%m%d-%H%M%S}.db")
+    tmp_path = path + ".part"
+    started = time.perf_counter()
+
+    src = storage.connect()
+    dst = sqlite3.connect(tmp_path)
+    try:
+        copy_database(src, dst, bot_id)
+    finally:
+        dst.close()
+        src.close()
+
+    if not check_integrity(tmp_path):
+        os.remove(tmp_path)
+        raise RuntimeError(f"Резервная копия {path} не прошла проверку целостности")
+    os.replace(tmp_path, path)
+
+    # Только что сделанная копия остаётся всегда, даже при BACKUP_KEEP=0
+    backups = list_backups()
+    for old in backups[:len(backups) - max(BACKUP_KEEP, 1)]:
+        os.remove(old)
+
+    size = os.path.getsize(path)
+    label = f'{{bot="{bot_id}"}}'
+    set_metric("backup_last_duration_seconds" + label, round(time.perf_counter() - started, 3))
+    set_metric("backup_last_size_bytes" + label, size)
+    set_metric("backup_last_success_timestamp" + label, int(time.time()))
+    logger.info("💾 Резервная копия %s: %s КБ", path, size // 1024)
+    return path
+
+
+def restore_backup(path: str):
+    """Восстанавливает базу из снимка. Запускать при остановленном боте.
+    Бот определяется по префиксу имени снимка."""
+    if not check_integrity(path):
+        raise RuntimeError(f"Снимок {path} повреждён")
+    name = os.path.basename(path)
+    matches = [bot_id for bot_id in sqlite_bots() if backup_name_re(bot_id).fullmatch(name)]
+    if not matches:
+        raise RuntimeError(f"Снимок {path} не относится ни к одному из ботов")
+    bot_id = matches[0]
+    src = sqlite3.connect(path)
+    dst = storages[bot_id].connect()
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    logger.info("♻️ База бота %s восстановлена из %s", bot_id, path)
+
+
+def backup_worker():
+    while True:
+        for bot_id in sqlite_bots():
+            current_bot.set(bot_id)
+            try:
+                make_backup()
+            except Exception as e:
+                inc_metric(f'backup_failures_total{{bot="{bot_id}"}}')
+                logger.error("Ошибка резервного копирования [%s]: %s", bot_id, e)
+        time.sleep(BACKUP_INTERVAL_HOURS * 3600)
+
 # --- КОМАНДЫ ---
 
 WELCOME_MSG = (
@@ -478,15 +2135,18 @@ WELCOME_MSG = (
     "• `/shop` — магазин профессий и улучшений\n"
     "• `/daily` — получить ежедневный бонус\n"
     "• `/child` — завести ребёнка\n"
+    "• `/history` — история бюджета семьи\n"
     "• `/divorce` — развестись\n"
     "• `/reset` — начать сначала\n\n"
     "💬 *Совет:* Чем дольше вы вместе, тем выше уровень семьи и больше бонусов!"
 )
 
+@traced("handler")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(escape_md(WELCOME_MSG), parse_mode='MarkdownV2')
 
 # --- /marry ---
+@traced("handler")
 async def marry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type == "private":
         await update.message.reply_text(escape_md("Только в группах!"), parse_mode='MarkdownV2')
@@ -495,7 +2155,7 @@ async def marry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
 
-    if is_married(user_id, chat_id):
+    if storage.is_married(user_id, chat_id):
         await update.message.reply_text(escape_md("Ты уже в браке!"), parse_mode='MarkdownV2')
         return
 
@@ -510,15 +2170,15 @@ async def marry(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(escape_md("Нельзя жениться на себе!"), parse_mode='MarkdownV2')
         return
 
-    if is_married(target_id, chat_id):
+    if storage.is_married(target_id, chat_id):
         await update.message.reply_text(escape_md("Твой избранник уже в браке!"), parse_mode='MarkdownV2')
         return
 
-    if not can_propose(user_id, chat_id):
+    if not storage.can_propose(user_id, chat_id):
         await update.message.reply_text(escape_md("Подожди 5 минут перед следующим предложением."), parse_mode='MarkdownV2')
         return
 
-    update_proposal_time(user_id, chat_id)
+    storage.update_proposal_time(user_id, chat_id)
     sender_name = await get_name(update, user_id)
     receiver_name = await get_name(update, target_id)
 
@@ -531,6 +2191,7 @@ async def marry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = f"💍 {sender_name} делает предложение {receiver_name}!\nСогласен(-на)?"
     await update.message.reply_text(escape_md(text), reply_markup=reply_markup, parse_mode='MarkdownV2')
 
+@traced("handler")
 async def marry_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data.split(":")
@@ -543,23 +2204,38 @@ async def marry_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Это не тебе предложение!", show_alert=True)
         return
 
+    await query.answer()
+
     if action == "marry_accept":
-        register_marriage(user_id, target_id, chat_id)
-        husband = await get_name(update, user_id)
-        wife = await get_name(update, target_id)
-        text = f"🎉 Поздравляем! {husband} и {wife} теперь в браке! 💍"
-        await query.edit_message_text(escape_md(text), parse_mode='MarkdownV2')
-        create_quest(user_id, chat_id, "have_child")
-        create_quest(target_id, chat_id, "have_child")
+        marriage = storage.is_married(target_id, chat_id)
+        if marriage and user_id in marriage[:2]:
+            return  # повторное нажатие, пока сообщение ещё не отредактировано
+        # Запись в базу остаётся под блокировкой чата, наружу уходит только ответ
+        storage.register_marriage(user_id, target_id, chat_id)
+        storage.create_quest(user_id, chat_id, "have_child")
+        storage.create_quest(target_id, chat_id, "have_child")
+        background.spawn(announce_marriage(update, user_id, target_id))
 
     elif action == "marry_reject":
-        sender = await get_name(update, user_id)
-        text = f"💔 {sender} был отклонён..."
-        await query.edit_message_text(escape_md(text), parse_mode='MarkdownV2')
+        background.spawn(announce_rejection(update, user_id))
 
-    await query.answer()
+
+@traced("task")
+async def announce_marriage(update: Update, user_id: int, target_id: int):
+    husband = await get_name(update, user_id)
+    wife = await get_name(update, target_id)
+    text = f"🎉 Поздравляем! {husband} и {wife} теперь в браке! 💍"
+    await update.callback_query.edit_message_text(escape_md(text), parse_mode='MarkdownV2')
+
+
+@traced("task")
+async def announce_rejection(update: Update, user_id: int):
+    sender = await get_name(update, user_id)
+    text = f"💔 {sender} был отклонён..."
+    await update.callback_query.edit_message_text(escape_md(text), parse_mode='MarkdownV2')
 
 # --- /reset ---
+@traced("handler")
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -579,13 +2255,14 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(escape_md(text), reply_markup=reply_markup, parse_mode='MarkdownV2')
 
+@traced("handler")
 async def reset_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data.split(":")
 
     if data[0] == "reset_cancel":
-        await query.edit_message_text(escape_md("❌ Сброс отменён."), parse_mode='MarkdownV2')
         await query.answer()
+        background.spawn(query.edit_message_text(escape_md("❌ Сброс отменён."), parse_mode='MarkdownV2'))
         return
 
     if data[0] != "reset_confirm":
@@ -599,16 +2276,18 @@ async def reset_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Это не ты запускал сброс!", show_alert=True)
         return
 
-    reset_user(user_id, chat_id)
-    await query.edit_message_text(escape_md("✅ Твой прогресс сброшен. Добро пожаловать в новую жизнь!"), parse_mode='MarkdownV2')
     await query.answer()
+    storage.reset_user(user_id, chat_id)
+    background.spawn(query.edit_message_text(
+        escape_md("✅ Твой прогресс сброшен. Добро пожаловать в новую жизнь!"), parse_mode='MarkdownV2'))
 
 # --- /work ---
+@traced("handler")
 async def work(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    create_user(user_id, chat_id)
-    user = get_user(user_id, chat_id)
+    storage.create_user(user_id, chat_id)
+    user = storage.get_user(user_id, chat_id)
     if not user:
         return
     job, _, last_work, total_works = user
@@ -628,26 +2307,27 @@ async def work(update: Update, context: ContextTypes.DEFAULT_TYPE):
         salary = int(salary * mult)
         event = f"\n🎁 Событие: *{evt_name}*"
 
-    if get_family_budget(user_id, chat_id) >= 1000:
+    if storage.get_family_budget(user_id, chat_id) >= 1000:
         passive = PASSIVE_INCOME["Дом"]
-        update_family_budget(user_id, chat_id, passive)
         event += f"\n🏠 Пассивный доход: +{passive}"
+        event += level_up_text(storage.update_family_budget(user_id, chat_id, passive, "passive"))
 
     new_streak = user[1] + 1 if last_work and datetime.now() - datetime.fromisoformat(last_work) < timedelta(days=1) else 1
     new_total = total_works + 1
-    update_work_stats(user_id, chat_id, new_streak, new_total)
-    update_family_budget(user_id, chat_id, salary)
+    storage.update_work_stats(user_id, chat_id, new_streak, new_total)
+    event += level_up_text(storage.update_family_budget(user_id, chat_id, salary, "salary"))
 
-    create_quest(user_id, chat_id, "work_5_times")
-    quest = get_quest(user_id, chat_id, "work_5_times")
+    storage.create_quest(user_id, chat_id, "work_5_times")
+    quest = storage.get_quest(user_id, chat_id, "work_5_times")
     if quest and not quest[1]:
         progress = min(quest[0] + 1, 5)
-        update_quest_progress(user_id, chat_id, "work_5_times", progress)
+        storage.update_quest_progress(user_id, chat_id, "work_5_times", progress)
         if progress >= 5:
             reward = QUESTS_INFO["work_5_times"]["reward"]
-            update_family_budget(user_id, chat_id, reward)
-            complete_quest_db(user_id, chat_id, "work_5_times")
+            level_result = storage.update_family_budget(user_id, chat_id, reward, "quest")
+            unlocked = storage.complete_quest_db(user_id, chat_id, "work_5_times")
             event += f"\n🏆 Квест завершён! +{reward} монет!"
+            event += level_up_text(level_result) + achievements_text(unlocked)
 
     await update.message.reply_text(
         escape_md(f"💼 Работал как {job}: +{salary} монет{event}\n🔥 Серия: {new_streak}"),
@@ -655,18 +2335,20 @@ async def work(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # --- /quests ---
+@traced("handler")
 async def quests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    create_user(user_id, chat_id)
+    card = get_card("quests", chat_id, user_id)
+    if card is not None:
+        await update.message.reply_text(card, parse_mode='MarkdownV2')
+        return
+
+    storage.create_user(user_id, chat_id)
     for q_type in QUESTS_INFO:
-        create_quest(user_id, chat_id, q_type)
+        storage.create_quest(user_id, chat_id, q_type)
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT quest_type, progress, completed, target FROM quests WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = storage.get_quests(user_id, chat_id)
 
     text = "🎯 *Твои квесты:*\n\n"
     for q_type, progress, completed, target in rows:
@@ -679,11 +2361,14 @@ async def quests(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += " (награда получена)"
         text += "\n"
 
-    await update.message.reply_text(escape_md(text), parse_mode='MarkdownV2')
+    card = escape_md(text)
+    put_card("quests", chat_id, user_id, card)
+    await update.message.reply_text(card, parse_mode='MarkdownV2')
 
 # --- /shop ---
+@traced("handler")
 async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    items = get_shop()
+    items = storage.get_shop()
     text = "🛒 *Магазин:*\n\n"
     for name, item_type, price, desc in items:
         emoji = "👔" if item_type == "job" else "🎁" if item_type == "gift" else "🏠"
@@ -692,6 +2377,7 @@ async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(escape_md(text), parse_mode='MarkdownV2')
 
 # --- /buy ---
+@traced("handler")
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(escape_md("Укажи: /buy Кассир"), parse_mode='MarkdownV2')
@@ -700,7 +2386,7 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
 
-    if buy_item(user_id, chat_id, item_name):
+    if storage.buy_item(user_id, chat_id, item_name):
         await update.message.reply_text(escape_md(f"✅ Куплено: {item_name}!"), parse_mode='MarkdownV2')
         if item_name in JOB_SALARY:
             await update.message.reply_text(escape_md(f"💼 Теперь ты {item_name}!"), parse_mode='MarkdownV2')
@@ -708,29 +2394,61 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(escape_md("❌ Не хватает денег или нет такого."), parse_mode='MarkdownV2')
 
 # --- /profile ---
+@traced("handler")
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
+    card = get_card("profile", chat_id, user_id)
+    if card is not None:
+        await update.message.reply_text(card, parse_mode='MarkdownV2')
+        return
+
+    # Данные читаются здесь, под блокировкой чата; в фоне — только запросы имён и edit
+    reservation = reserve_card("profile", chat_id, user_id)
+    storage.create_user(user_id, chat_id)
+    user = storage.get_user(user_id, chat_id)
+    marriage = storage.is_married(user_id, chat_id)
+    codes = storage.get_achievements(user_id, chat_id)
+    if marriage and "anniversary" not in codes:
+        codes += check_anniversary(marriage, chat_id)
+
+    placeholder = await update.message.reply_text(escape_md("⏳ Собираю профиль..."), parse_mode='MarkdownV2')
+    background.spawn(deliver_profile(update, placeholder, reservation, user, marriage, codes))
+
+
+@traced("task")
+async def deliver_profile(update: Update, placeholder, reservation, user, marriage, codes: list):
+    try:
+        card, expires = await render_profile(update, user, marriage, codes)
+    except Exception:
+        # Иначе у пользователя навсегда останется заглушка; саму ошибку запишет BackgroundTasks.run
+        await placeholder.edit_text(escape_md("⚠️ Не удалось собрать профиль, попробуй ещё раз."), parse_mode='MarkdownV2')
+        raise
+    put_card("profile", update.effective_chat.id, update.effective_user.id, card, reservation, expires)
+    await placeholder.edit_text(card, parse_mode='MarkdownV2')
+
+
+async def render_profile(update: Update, user, marriage, codes: list) -> tuple:
+    """Текст карточки /profile и момент, когда она устареет (или None)."""
+    user_id = update.effective_user.id
     user_name = await get_name(update, user_id)
-    create_user(user_id, chat_id)
-    user = get_user(user_id, chat_id)
     job, streak, _, total_works = user if user else ("Безработный", 0, None, 0)
-
-    marriage = is_married(user_id, chat_id)
-    kids = count_children(user_id, chat_id)
-    budget = get_family_budget(user_id, chat_id)
-    achievements = get_achievements(user_id, chat_id)
-    ach_text = "\n".join([f"🔹 {a}" for a in achievements])
+    kids = marriage[7] if marriage else 0
+    budget = marriage[3] if marriage else 0
+    ach_text = "\n".join([f"🔹 {a}" for a in achievement_titles(codes, marriage)])
 
     status = "💍 В браке" if marriage else "👤 Холост(а)"
     married_to = ""
     level_info = ""
+    expires = None
     if marriage:
         partner_id = marriage[1] if marriage[0] == user_id else marriage[0]
         partner_name = await get_name(update, partner_id)
-        days = (datetime.now() - datetime.fromisoformat(marriage[2])).days
-        level, title, _ = update_family_level(user_id, chat_id)
-        level_info = f"\n• Уровень семьи: {level} — {title}"
+        married_at = datetime.fromisoformat(marriage[2])
+        days = (datetime.now() - married_at).days
+        expires = married_at + timedelta(days=days + 1)  # когда счётчик дней сменится
+        level = marriage[5]
+        level_info = f"\n• Уровень семьи: {level} — {family_level_title(level)}"
         married_to = f"\n• Партнёр: {partner_name}\n• Вместе: {days} дней"
 
     text = (
@@ -743,14 +2461,15 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💰 Бюджет: {budget} монет\n\n"
         f"🏆 Достижения:\n{ach_text}"
     )
-    await update.message.reply_text(escape_md(text), parse_mode='MarkdownV2')
+    return escape_md(text), expires
 
 # --- /daily ---
+@traced("handler")
 async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    create_user(user_id, chat_id)
-    marriage = is_married(user_id, chat_id)
+    storage.create_user(user_id, chat_id)
+    marriage = storage.is_married(user_id, chat_id)
     if not marriage:
         await update.message.reply_text(escape_md("Только для супругов!"), parse_mode='MarkdownV2')
         return
@@ -763,26 +2482,21 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     amount = 50
-    if get_family_budget(user_id, chat_id) >= 1000:
+    if marriage[3] >= 1000:
         amount = 100
 
-    update_family_budget(user_id, chat_id, amount)
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE marriages SET last_daily = datetime("now") WHERE (user1 = ? OR user2 = ?) AND chat_id = ?', (user_id, user_id, chat_id))
-    conn.commit()
-    conn.close()
-
-    new_level, title, level_up = update_family_level(user_id, chat_id)
-    bonus = f"\n🎉 Повышен до уровня {new_level}: {title}!" if level_up else ""
+    bonus = level_up_text(storage.update_family_budget(user_id, chat_id, amount, "daily"))
+    bonus += achievements_text(check_anniversary(marriage, chat_id))
+    storage.set_last_daily(user_id, chat_id)
 
     await update.message.reply_text(escape_md(f"🎁 Ежедневный бонус: +{amount} монет!{bonus}"), parse_mode='MarkdownV2')
 
 
+@traced("handler")
 async def casino(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    if not is_married(user_id, chat_id):
+    if not storage.is_married(user_id, chat_id):
         await update.message.reply_text(escape_md("Только для супругов!"), parse_mode='MarkdownV2')
         return
 
@@ -796,7 +2510,7 @@ async def casino(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(escape_md("Введите число."), parse_mode='MarkdownV2')
         return
 
-    budget = get_family_budget(user_id, chat_id)
+    budget = storage.get_family_budget(user_id, chat_id)
     if bet > budget:
         await update.message.reply_text(escape_md("Недостаточно монет!"), parse_mode='MarkdownV2')
         return
@@ -806,20 +2520,21 @@ async def casino(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if random.random() < 0.6:
         win = bet * 2
-        update_family_budget(user_id, chat_id, win - bet)
         result = f"🎉 Вы выиграли {win} монет!"
+        result += level_up_text(storage.update_family_budget(user_id, chat_id, win - bet, "casino"))
     else:
-        update_family_budget(user_id, chat_id, -bet)
+        storage.update_family_budget(user_id, chat_id, -bet, "casino")
         result = f"💸 Проиграли {bet} монет..."
 
     await update.message.reply_text(escape_md(f"🎲 Казино: {result}"), parse_mode='MarkdownV2')
 
 
 # --- /gift ---
+@traced("handler")
 async def gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    marriage = is_married(user_id, chat_id)
+    marriage = storage.is_married(user_id, chat_id)
     if not marriage:
         await update.message.reply_text(escape_md("Ты не в браке!"), parse_mode='MarkdownV2')
         return
@@ -834,11 +2549,11 @@ async def gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                         parse_mode='MarkdownV2')
         return
 
-    if get_family_budget(user_id, chat_id) < 150:
+    if storage.get_family_budget(user_id, chat_id) < 150:
         await update.message.reply_text(escape_md("Недостаточно монет!"), parse_mode='MarkdownV2')
         return
 
-    update_family_budget(user_id, chat_id, -150)
+    storage.update_family_budget(user_id, chat_id, -150, "gift")
     partner_id = marriage[1] if marriage[0] == user_id else marriage[0]
     sender = await get_name(update, user_id)
     receiver = await get_name(update, partner_id)
@@ -846,119 +2561,426 @@ async def gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- /child ---
+@traced("handler")
 async def child(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    marriage = is_married(user_id, chat_id)
+    marriage = storage.is_married(user_id, chat_id)
     if not marriage:
         await update.message.reply_text(escape_md("Только для супругов!"), parse_mode='MarkdownV2')
         return
 
-    kids = count_children(user_id, chat_id)
+    kids = marriage[7]
     if kids >= 5:
         await update.message.reply_text(escape_md("У вас уже много детей!"), parse_mode='MarkdownV2')
         return
 
-    if get_family_budget(user_id, chat_id) < 100:
+    if storage.get_family_budget(user_id, chat_id) < 100:
         await update.message.reply_text(escape_md("Нужно 100 монет на воспитание!"), parse_mode='MarkdownV2')
         return
 
-    update_family_budget(user_id, chat_id, -100)
-    u1, u2 = marriage[0], marriage[1]
+    storage.update_family_budget(user_id, chat_id, -100, "child")
     name = f"Ребёнок-{random.randint(100, 999)}"
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO children (parent1, parent2, chat_id, name)
-        VALUES (?, ?, ?, ?)
-    ''', (u1, u2, chat_id, name))
-    conn.commit()
-    conn.close()
+    bonus = level_up_text(storage.add_child(marriage, chat_id, name))
 
-    if get_quest(user_id, chat_id, "have_child") and not get_quest(user_id, chat_id, "have_child")[1]:
+    if storage.get_quest(user_id, chat_id, "have_child") and not storage.get_quest(user_id, chat_id, "have_child")[1]:
         reward = QUESTS_INFO["have_child"]["reward"]
-        update_family_budget(user_id, chat_id, reward)
-        complete_quest_db(user_id, chat_id, "have_child")
-        await update.message.reply_text(escape_md(f"👶 У вас родился {name}!\n🏆 Квест завершён! +{reward} монет!"),
+        bonus += level_up_text(storage.update_family_budget(user_id, chat_id, reward, "quest"))
+        bonus += achievements_text(storage.complete_quest_db(user_id, chat_id, "have_child"))
+        await update.message.reply_text(escape_md(f"👶 У вас родился {name}!\n🏆 Квест завершён! +{reward} монет!{bonus}"),
                                         parse_mode='MarkdownV2')
     else:
-        await update.message.reply_text(escape_md(f"👶 У вас родился {name}!"), parse_mode='MarkdownV2')
+        await update.message.reply_text(escape_md(f"👶 У вас родился {name}!{bonus}"), parse_mode='MarkdownV2')
+
+
+# --- /history ---
+@traced("handler")
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    if not storage.is_married(user_id, chat_id):
+        await update.message.reply_text(escape_md("Только для супругов!"), parse_mode='MarkdownV2')
+        return
+
+    rows = storage.get_history(user_id, chat_id, HISTORY_DAYS)
+    if not rows:
+        await update.message.reply_text(escape_md(f"📜 За {HISTORY_DAYS} дней движений по бюджету не было."), parse_mode='MarkdownV2')
+        return
+
+    text = f"📜 *История бюджета за {HISTORY_DAYS} дней:*\n"
+    current_day = None
+    for day, reason, credit, debit in rows:
+        if day != current_day:
+            current_day = day
+            text += f"\n*{day}*\n"
+        parts = []
+        if credit:
+            parts.append(f"+{credit}")
+        if debit:
+            parts.append(f"-{debit}")
+        text += f"{LEDGER_REASONS.get(reason, reason)}: {' / '.join(parts) or '0'}\n"
+
+    await update.message.reply_text(escape_md(text), parse_mode='MarkdownV2')
+
+
+# --- /economy ---
+@traced("handler")
+async def economy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    rows = storage.get_chat_economy(chat_id, HISTORY_DAYS)
+    if not rows:
+        await update.message.reply_text(escape_md(f"📊 За {HISTORY_DAYS} дней в чате не было движений бюджета."), parse_mode='MarkdownV2')
+        return
+
+    text = f"📊 *Экономика чата за {HISTORY_DAYS} дней:*\n\n"
+    total_credit = total_debit = 0
+    for reason, credit, debit, entries in rows:
+        total_credit += credit
+        total_debit += debit
+        text += f"{LEDGER_REASONS.get(reason, reason)}: +{credit} / -{debit} ({entries} оп.)\n"
+    text += f"\n💰 Итого: +{total_credit} / -{total_debit}"
+
+    await update.message.reply_text(escape_md(text), parse_mode='MarkdownV2')
 
 
 # --- /divorce ---
+@traced("handler")
 async def divorce_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    if not is_married(user_id, chat_id):
+    if not storage.is_married(user_id, chat_id):
         await update.message.reply_text(escape_md("Ты и так свободен!"), parse_mode='MarkdownV2')
         return
 
-    divorce(user_id, chat_id)
+    storage.divorce(user_id, chat_id)
     await update.message.reply_text(escape_md("💔 Вы развелись..."), parse_mode='MarkdownV2')
 
 
-# --- Регистрация обработчиков ---
-def register_handlers():
-    telegram_app.add_handler(CommandHandler("start", start))
-    telegram_app.add_handler(CommandHandler("marry", marry))
-    telegram_app.add_handler(CommandHandler("work", work))
-    telegram_app.add_handler(CommandHandler("quests", quests))
-    telegram_app.add_handler(CommandHandler("shop", shop))
-    telegram_app.add_handler(CommandHandler("buy", buy))
-    telegram_app.add_handler(CommandHandler("profile", profile))
-    telegram_app.add_handler(CommandHandler("daily", daily))
-    telegram_app.add_handler(CommandHandler("casino", casino))
-    telegram_app.add_handler(CommandHandler("gift", gift))
-    telegram_app.add_handler(CommandHandler("child", child))
-    telegram_app.add_handler(CommandHandler("divorce", divorce_cmd))
-    telegram_app.add_handler(CommandHandler("reset", reset))
-
-    telegram_app.add_handler(CallbackQueryHandler(marry_callback, pattern=r"^marry_"))
-    telegram_app.add_handler(CallbackQueryHandler(reset_callback, pattern=r"^reset_"))
+# --- Ограничение частоты команд ---
+def parse_rate(value: str) -> tuple:
+    """"3/60" -> (3, 60.0): запросов за окно в секундах."""
+    limit, _, window = value.partition("/")
+    return int(limit), float(window)
+
 
+# (запросов, окно в секундах) на пользователя в чате; остальные команды — по "default".
+# RATE_LIMITS="work=3/60,default=10/10" переопределяет отдельные команды
+RATE_LIMITS = {
+    "default": (5, 10),
+    "work": (3, 60),
+    "casino": (5, 30),
+    "profile": (3, 30),
+    "quests": (3, 30),
+    "daily": (2, 60),
+}
+RATE_LIMITS.update({
+    command.strip().lower(): parse_rate(rate)
+    for command, _, rate in (item.partition("=") for item in os.getenv("RATE_LIMITS", "").split(","))
+    if rate
+})
+# Все команды чата вместе, тот же формат: CHAT_RATE_LIMIT="30/10"
+CHAT_RATE_LIMIT = parse_rate(os.getenv("CHAT_RATE_LIMIT", "30/10"))
+
+
+class SlidingWindowLimiter:
+    """Скользящее окно в памяти: хранит отметки времени последних запросов по ключу."""
+
+    def __init__(self, sweep_every: int = 1000):
+        self.hits = {}
+        self.warned_until = {}
+        self.sweep_every = sweep_every
+        self.calls = 0
+
+    def is_limited(self, key, limit: int, window: float, now: float) -> bool:
+        hits = self.hits.get(key)
+        if not hits:
+            return False
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        return len(hits) >= limit
+
+    def record(self, key, now: float):
+        self.hits.setdefault(key, deque()).append(now)
+        self.calls += 1
+        if self.calls % self.sweep_every == 0:
+            self.sweep(now)
+
+    def should_warn(self, key, window: float, now: float) -> bool:
+        """Не больше одного предупреждения за окно."""
+        if self.warned_until.get(key, 0) > now:
+            return False
+        self.warned_until[key] = now + window
+        return True
+
+    def sweep(self, now: float):
+        longest = max(window for _, window in [*RATE_LIMITS.values(), CHAT_RATE_LIMIT])
+        for key in [k for k, hits in self.hits.items() if not hits or hits[-1] <= now - longest]:
+            del self.hits[key]
+        for key in [k for k, until in self.warned_until.items() if until <= now]:
+            del self.warned_until[key]
+
+
+command_limiter = SlidingWindowLimiter()
+
+
+async def rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отсекает слишком частые команды до обработчиков и обращений к БД."""
+    message = update.effective_message
+    if not message or not message.text or not message.text.startswith('/'):
+        return
+    if not update.effective_user or not update.effective_chat:
+        return
+
+    command = message.text.split()[0][1:].split('@')[0].lower()
+    limit, window = RATE_LIMITS.get(command, RATE_LIMITS["default"])
+    chat_limit, chat_window = CHAT_RATE_LIMIT
+    bot_id = current_bot.get()
+    user_key = (bot_id, update.effective_chat.id, update.effective_user.id, command)
+    chat_key = (bot_id, update.effective_chat.id)
+    now = time.monotonic()
+
+    if command_limiter.is_limited(user_key, limit, window, now):
+        if command_limiter.should_warn(user_key, window, now):
+            await message.reply_text(escape_md("⏳ Слишком часто! Подожди немного."), parse_mode='MarkdownV2')
+        raise ApplicationHandlerStop
+    if command_limiter.is_limited(chat_key, chat_limit, chat_window, now):
+        # Флуд в чате целиком — молча отбрасываем
+        raise ApplicationHandlerStop
+
+    command_limiter.record(user_key, now)
+    command_limiter.record(chat_key, now)
+
+
+# --- Регистрация обработчиков ---
+def register_handlers(application: Application):
+    application.add_handler(TypeHandler(Update, rate_limit), group=-1)
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("marry", marry))
+    application.add_handler(CommandHandler("work", work))
+    application.add_handler(CommandHandler("quests", quests))
+    application.add_handler(CommandHandler("shop", shop))
+    application.add_handler(CommandHandler("buy", buy))
+    application.add_handler(CommandHandler("profile", profile))
+    application.add_handler(CommandHandler("daily", daily))
+    application.add_handler(CommandHandler("casino", casino))
+    application.add_handler(CommandHandler("gift", gift))
+    application.add_handler(CommandHandler("child", child))
+    application.add_handler(CommandHandler("divorce", divorce_cmd))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("economy", economy))
+    application.add_handler(CommandHandler("reset", reset))
+
+    application.add_handler(CallbackQueryHandler(marry_callback, pattern=r"^marry_"))
+    application.add_handler(CallbackQueryHandler(reset_callback, pattern=r"^reset_"))
+
+
+# --- Дедупликация апдейтов ---
+# Telegram повторяет доставку, если ответ на webhook задержался. Повтор узнаём по update_id.
+# Доставка бывает не по порядку, поэтому храним не максимум, а «пол»: все id до него приняты,
+# плюс множество принятых id выше пола. И то, и другое сохраняется в хранилище бота.
+DEDUPE_WINDOW = int(os.getenv("DEDUPE_WINDOW", "10000"))
+DEDUPE_FLUSH_SECONDS = 1.0
+# После недели без апдейтов Telegram начинает нумерацию со случайного числа — старая отметка больше не годится
+DEDUPE_MARK_TTL = timedelta(days=6).total_seconds()
+
+
+class UpdateDeduplicator:
+    def __init__(self, window: int):
+        self.window = window
+        self.lock = threading.Lock()
+        self.bots = {}   # bot_id -> {"floor", "above", "heap", "version", "saved", "last"}
+
+    def load(self, bot_id: str) -> dict:
+        mark = storages[bot_id].get_update_mark()
+        floor, pending = None, []
+        if mark and time.time() - mark[1] < DEDUPE_MARK_TTL:
+            floor, pending = mark[0], mark[2]
+        return {"floor": floor, "above": set(pending), "heap": sorted(pending),
+                "version": 0, "saved": 0, "last": time.time()}
+
+    def advance(self, state: dict):
+        """Поднимает пол по непрерывной цепочке принятых id; при переполнении окна
+        считает обработанным всё до самого старого принятого id."""
+        above, heap = state["above"], state["heap"]
+        while heap:
+            if heap[0] not in above:
+                heapq.heappop(heap)  # id, снятый через forget
+            elif heap[0] == state["floor"] + 1 or len(above) > self.window:
+                state["floor"] = heapq.heappop(heap)
+                above.discard(state["floor"])
+            else:
+                break
+
+    def accept(self, bot_id: str, update_id: int) -> bool:
+        """True, если апдейт новый и его нужно обработать; повторы возвращают False."""
+        with self.lock:
+            state = self.bots.get(bot_id)
+            now = time.time()
+            if state is None:
+                state = self.bots[bot_id] = self.load(bot_id)
+            elif now - state["last"] >= DEDUPE_MARK_TTL:
+                state["floor"] = None
+                state["above"].clear()
+                state["heap"].clear()
+            state["last"] = now
+            if state["floor"] is None:
+                state["floor"] = update_id - 1
+
+            if update_id <= state["floor"] or update_id in state["above"]:
+                return False
+            state["above"].add(update_id)
+            heapq.heappush(state["heap"], update_id)
+            self.advance(state)
+            state["version"] += 1
+            return True
+
+    def forget(self, bot_id: str, update_id: int):
+        """Снимает отметку с апдейта, который не удалось передать на обработку: повтор Telegram его примет."""
+        with self.lock:
+            state = self.bots.get(bot_id)
+            if state is None:
+                return
+            if update_id in state["above"]:
+                state["above"].discard(update_id)
+            elif state["floor"] - self.window < update_id <= state["floor"]:
+                # Пол уже прошёл этот id: опускаем его, id между ними остаются принятыми
+                for accepted in range(update_id + 1, state["floor"] + 1):
+                    state["above"].add(accepted)
+                    heapq.heappush(state["heap"], accepted)
+                state["floor"] = update_id - 1
+            else:
+                return
+            state["version"] += 1
+
+    def flush(self):
+        """Сохраняет изменившиеся отметки. Вызывается из фонового потока, не из обработки webhook."""
+        with self.lock:
+            pending = {bot_id: (state["floor"], sorted(state["above"]), state["version"])
+                       for bot_id, state in self.bots.items()
+                       if state["version"] != state["saved"] and state["floor"] is not None}
+        for bot_id, (floor, above, version) in pending.items():
+            storages[bot_id].set_update_mark(floor, above)
+            with self.lock:
+                self.bots[bot_id]["saved"] = version
+
+
+update_dedupe = UpdateDeduplicator(DEDUPE_WINDOW)
+
+
+def dedupe_worker():
+    while True:
+        time.sleep(DEDUPE_FLUSH_SECONDS)
+        try:
+            update_dedupe.flush()
+        except Exception as e:
+            logger.error("Ошибка сохранения отметки апдейтов: %s", e)
 
 # --- Webhook ---
 @app.route('/webhook', methods=['POST'])
-def webhook():
+def default_webhook():
+    # Старый адрес без bot_id — бот по умолчанию
+    return webhook(DEFAULT_BOT_ID)
+
+
+@app.route('/webhook/<bot_id>', methods=['POST'])
+def webhook(bot_id):
+    application = applications.get(bot_id)
+    if application is None:
+        return 'Not Found', 404
+    accepted = None
     try:
         json_data = request.get_json()
         if not json_data:
             return 'OK', 200
 
+        update_id = json_data.get("update_id")
+        inc_metric(f'updates_received_total{{bot="{bot_id}"}}')
+        if update_id is not None and not update_dedupe.accept(bot_id, update_id):
+            # Повтор: подтверждаем сразу, чтобы Telegram перестал его слать, и не обрабатываем
+            inc_metric(f'updates_duplicate_total{{bot="{bot_id}"}}')
+            return 'OK', 200
+        accepted = update_id
+
+        root = start_trace("webhook", update_id, bot=bot_id)
+
         # Создаем Update объект
-        update = Update.de_json(json_data, telegram_app.bot)
+        update = Update.de_json(json_data, application.bot)
 
         # Обрабатываем update в event loop
+        queued = root.child("loop_hop") if root else None
         asyncio.run_coroutine_threadsafe(
-            telegram_app.process_update(update),
+            dispatch_update(bot_id, update, root, queued),
             bot_loop
         )
         return 'OK', 200
     except Exception as e:
-        logger.error(f"Ошибка в webhook: {e}")
+        logger.error("Ошибка в webhook: %s", e)
+        if accepted is not None:
+            update_dedupe.forget(bot_id, accepted)
         return 'ERROR', 500
 
 
+def is_admin_request() -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    # Сравнение за постоянное время: по длительности нельзя подбирать токен посимвольно
+    expected = ADMIN_TOKEN.encode()
+    token = request.headers.get('X-Admin-Token', '').encode()
+    bearer = request.headers.get('Authorization', '').encode()
+    return hmac.compare_digest(token, expected) or hmac.compare_digest(bearer, b"Bearer " + expected)
+
+
+@app.route('/traces', methods=['GET'])
+def traces():
+    if not is_admin_request():
+        return 'Not Found', 404
+    limit = request.args.get('limit', default=200, type=int)
+    return jsonify(list(trace_buffer)[-limit:]), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not is_admin_request():
+        return 'Not Found', 404
+    with metrics_lock:
+        lines = [f"{name} {value}" for name, value in sorted(metrics.items())]
+    return "\n".join(lines) + "\n", 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/profiler', methods=['GET', 'POST'])
+def profiler_endpoint():
+    if not is_admin_request():
+        return 'Not Found', 404
+    if request.method == 'POST':
+        seconds = request.args.get('seconds', type=float)
+        updates = request.args.get('updates', type=int)
+        if not profiler.start(seconds=seconds if seconds or updates else 30, updates=updates):
+            return jsonify(error='Профилировщик уже запущен или бот не готов'), 409
+        return jsonify(profiler.status()), 202
+    return jsonify(profiler.status()), 200
+
+
 @app.route('/', methods=['GET'])
 def home():
     return '✅ Marriage Bot is running!', 200
 
 
 # --- Установка webhook ---
-def set_webhook():
+def set_webhook(bot_id: str, application: Application):
     hostname = os.getenv('RENDER_EXTERNAL_HOSTNAME')
     if hostname:
-        url = f"https://{hostname}/webhook"
-        logger.info(f"Setting webhook: {url}")
+        url = f"https://{hostname}/webhook/{bot_id}"
+        logger.info("Setting webhook: %s", url)
         try:
             future = asyncio.run_coroutine_threadsafe(
-                telegram_app.bot.set_webhook(url=url),
+                application.bot.set_webhook(url=url),
                 bot_loop
             )
             future.result(timeout=10)  # Ждём завершения с таймаутом
-            logger.info("✅ Webhook установлен!")
+            logger.info("✅ Webhook бота %s установлен!", bot_id)
         except Exception as e:
-            logger.error(f"❌ Ошибка установки webhook: {e}")
+            logger.error("❌ Ошибка установки webhook бота %s: %s", bot_id, e)
     else:
         logger.warning("⚠️ RENDER_EXTERNAL_HOSTNAME не задан — webhook не установлен.")
 
@@ -966,66 +2988,101 @@ def set_webhook():
 # --- Graceful shutdown ---
 def shutdown():
     logger.info("🛑 Остановка бота...")
-    if telegram_app and telegram_app.running:
+    if bot_loop and bot_loop.is_running():
+        # Дожидаемся начатых ответов, пока клиент Bot API ещё открыт
+        asyncio.run_coroutine_threadsafe(background.drain(5), bot_loop).result(timeout=6)
+    for application in applications.values():
+        if not application.running:
+            continue
         # Останавливаем приложение в event loop
-        future = asyncio.run_coroutine_threadsafe(telegram_app.stop(), bot_loop)
+        future = asyncio.run_coroutine_threadsafe(application.stop(), bot_loop)
         future.result(timeout=5)
-        future = asyncio.run_coroutine_threadsafe(telegram_app.shutdown(), bot_loop)
+        future = asyncio.run_coroutine_threadsafe(application.shutdown(), bot_loop)
         future.result(timeout=5)
+    update_dedupe.flush()
     logger.info("✅ Бот остановлен")
 
 
 # --- Запуск бота в отдельном потоке ---
 def run_bot():
-    global telegram_app, bot_loop
+    global bot_loop, bot_thread_id, update_scheduler
 
     try:
         # Создаем новый event loop для бота
         bot_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(bot_loop)
+        bot_thread_id = threading.get_ident()
+        update_scheduler = UpdateScheduler(MAX_CONCURRENT_UPDATES)
 
-        # Создаем приложение
-        telegram_app = Application.builder().token(TOKEN).build()
+        # Один HTTP-клиент (и пул соединений к Bot API) на все боты
+        bot_request = TracingRequest()
+        for bot_id, token in BOT_TOKENS.items():
+            # Создаем приложение
+            application = Application.builder().token(token).request(bot_request).build()
 
-        # Регистрируем обработчики
-        register_handlers()
+            # Регистрируем обработчики
+            register_handlers(application)
 
-        # Инициализируем приложение
-        bot_loop.run_until_complete(telegram_app.initialize())
+            # Инициализируем приложение
+            bot_loop.run_until_complete(application.initialize())
+            applications[bot_id] = application
 
-        # Устанавливаем webhook
-        set_webhook()
+            # Устанавливаем webhook
+            set_webhook(bot_id, application)
 
-        logger.info("✅ Бот успешно запущен и готов к работе!")
+        logger.info("✅ Боты запущены и готовы к работе: %s", ", ".join(applications))
 
         # Запускаем event loop
         bot_loop.run_forever()
 
     except Exception as e:
-        logger.error(f"❌ Ошибка при запуске бота: {e}")
+        logger.error("❌ Ошибка при запуске бота: %s", e)
     finally:
         shutdown()
 
 
 # --- Запуск ---
 if __name__ == '__main__':
+    # Обслуживание: python bot.py backup | python bot.py restore [путь к снимку]
+    if len(sys.argv) > 1 and sys.argv[1] in ('backup', 'restore'):
+        if sys.argv[1] == 'backup':
+            for bot_id in sqlite_bots():
+                current_bot.set(bot_id)
+                make_backup()
+        else:
+            snapshots = list_backups()
+            snapshot = sys.argv[2] if len(sys.argv) > 2 else (snapshots[-1] if snapshots else None)
+            if not snapshot:
+                sys.exit("Нет снимков для восстановления")
+            restore_backup(snapshot)
+        sys.exit(0)
+
     try:
         # 1. Инициализация БД
         logger.info("🔄 Инициализация базы данных...")
-        init_db()
+        for backend in storages.values():
+            backend.init()
 
         # 2. Запускаем бота в отдельном потоке
         logger.info("🔄 Запуск Telegram бота...")
         bot_thread = threading.Thread(target=run_bot, daemon=True)
         bot_thread.start()
+        threading.Thread(target=dedupe_worker, daemon=True).start()
+
+        # 3. Периодическая очистка базы и резервные копии (только для SQLite)
+        if sqlite_bots():
+            if RETENTION_INTERVAL_HOURS > 0:
+                threading.Thread(target=retention_worker, daemon=True).start()
+            if BACKUP_INTERVAL_HOURS > 0:
+                threading.Thread(target=backup_worker, daemon=True).start()
 
-        # 3. Запуск Flask
+        # 4. Запуск Flask
         logger.info("🚀 Запуск Flask приложения...")
         port = int(os.environ.get("PORT", 10000))
         app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
 
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка при запуске: {e}")
+        logger.error("❌ Критическая ошибка при запуске: %s", e)
         shutdown()
     except KeyboardInterrupt:
         logger.info("🛑 Получен сигнал прерывания...")
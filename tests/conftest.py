@@ -0,0 +1,5 @@
+import os
+import sys
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
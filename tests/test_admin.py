@@ -0,0 +1,23 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("headers, allowed", [
+    ({"X-Admin-Token": "secret"}, True),
+    ({"Authorization": "Bearer secret"}, True),
+    ({"X-Admin-Token": "secreT"}, False),
+    ({"Authorization": "secret"}, False),
+    ({"X-Admin-Token": "сикрет"}, False),
+    ({}, False),
+])
+def test_is_admin_request(monkeypatch, headers, allowed):
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", "secret")
+    with bot.app.test_request_context(headers=headers):
+        assert bot.is_admin_request() is allowed
+
+
+def test_admin_endpoints_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", None)
+    with bot.app.test_request_context(headers={"X-Admin-Token": ""}):
+        assert bot.is_admin_request() is False
@@ -0,0 +1,28 @@
+import os
+
+import bot
+
+
+def touch(directory, name):
+    open(os.path.join(directory, name), "w").close()
+
+
+def test_list_backups_matches_full_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_DIR", str(tmp_path))
+    for name in ("marriage_bot_a-20260101-000000.db", "marriage_bot_a-b-20260101-000000.db",
+                 "marriage_bot_a-20260101-000000.db.part", "marriage_bot_a-notes.db"):
+        touch(tmp_path, name)
+    assert [os.path.basename(p) for p in bot.list_backups("a")] == ["marriage_bot_a-20260101-000000.db"]
+    assert [os.path.basename(p) for p in bot.list_backups("a-b")] == ["marriage_bot_a-b-20260101-000000.db"]
+
+
+def test_rotation_keeps_latest_backup_when_keep_is_zero(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(bot, "BACKUP_KEEP", 0)
+    backend = bot.SQLiteStorage(str(tmp_path / "test.db"))
+    backend.init()
+    monkeypatch.setitem(bot.storages, bot.DEFAULT_BOT_ID, backend)
+    os.makedirs(bot.BACKUP_DIR)
+    touch(bot.BACKUP_DIR, "marriage_bot-20000101-000000.db")
+    path = bot.make_backup()
+    assert bot.list_backups(bot.DEFAULT_BOT_ID) == [path]
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+
+def test_card_expires_at_given_moment():
+    bot.card_cache.clear()
+    bot.put_card("profile", 10, 1, "fresh", expires=datetime.now() + timedelta(hours=1))
+    bot.put_card("profile", 10, 2, "stale", expires=datetime.now() - timedelta(seconds=1))
+    bot.put_card("quests", 10, 1, "timeless")
+    assert bot.get_card("profile", 10, 1) == "fresh"
+    assert bot.get_card("profile", 10, 2) is None
+    assert bot.get_card("quests", 10, 1) == "timeless"
+    bot.card_cache.clear()
+
+
+def test_reserved_card_is_dropped_after_invalidation():
+    bot.card_cache.clear()
+    reservation = bot.reserve_card("profile", 10, 1)
+    assert bot.get_card("profile", 10, 1) is None
+    bot.invalidate_cards(10, 1)
+    bot.put_card("profile", 10, 1, "old data", reservation)
+    assert bot.get_card("profile", 10, 1) is None
+    bot.card_cache.clear()
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "memory"])
+def test_storage_proxy_invalidates_spouse_cards(kind, tmp_path, monkeypatch):
+    backend = bot.SQLiteStorage(str(tmp_path / "test.db")) if kind == "sqlite" else bot.MemoryStorage()
+    backend.init()
+    monkeypatch.setitem(bot.storages, bot.DEFAULT_BOT_ID, backend)
+    bot.card_cache.clear()
+    bot.storage.register_marriage(1, 2, 10)
+    bot.put_card("profile", 10, 2, "spouse")
+    bot.put_card("profile", 10, 3, "stranger")
+
+    bot.storage.update_family_budget(1, 10, 100, "salary")
+    assert bot.get_card("profile", 10, 2) is None
+    assert bot.get_card("profile", 10, 3) == "stranger"
+
+    bot.put_card("profile", 10, 2, "spouse")
+    bot.storage.divorce(1, 10)
+    assert bot.get_card("profile", 10, 2) is None
+
+    # Чтения и create_user карточку не трогают, иначе /profile никогда не попал бы в кэш
+    reservation = bot.reserve_card("profile", 10, 3)
+    bot.storage.create_user(3, 10)
+    bot.storage.get_achievements(3, 10)
+    bot.storage.unlock_achievements((3,), 10, [])
+    bot.put_card("profile", 10, 3, "fresh", reservation)
+    assert bot.get_card("profile", 10, 3) == "fresh"
+    bot.card_cache.clear()
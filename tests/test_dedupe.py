@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+import bot
+
+BOT = "dedupe-test"
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = bot.MemoryStorage()
+    backend.init()
+    monkeypatch.setitem(bot.storages, BOT, backend)
+    return backend
+
+
+def accepted(dedupe, ids) -> list:
+    return [update_id for update_id in ids if dedupe.accept(BOT, update_id)]
+
+
+def test_out_of_order_updates_are_accepted_once(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    assert accepted(dedupe, [10, 12, 11, 14]) == [10, 12, 11, 14]
+    state = dedupe.bots[BOT]
+    assert (state["floor"], state["above"]) == (12, {14})
+    assert accepted(dedupe, [13, 15]) == [13, 15]
+    assert (state["floor"], state["above"]) == (15, set())
+
+
+def test_duplicates_below_floor_and_above_are_dropped(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    accepted(dedupe, [10, 11, 13])
+    assert not dedupe.accept(BOT, 10)  # ниже пола
+    assert not dedupe.accept(BOT, 13)  # в above
+    assert dedupe.accept(BOT, 12)
+
+
+def test_forget_above_floor(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    accepted(dedupe, [10, 12])
+    dedupe.forget(BOT, 12)
+    assert dedupe.accept(BOT, 12)
+    assert not dedupe.accept(BOT, 12)
+
+
+def test_forget_after_floor_passed(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    accepted(dedupe, [10, 11, 12, 13])
+    dedupe.forget(BOT, 11)
+    state = dedupe.bots[BOT]
+    assert (state["floor"], state["above"]) == (10, {12, 13})
+    assert accepted(dedupe, [12, 13, 11, 14]) == [11, 14]
+    assert (state["floor"], state["above"]) == (14, set())
+
+
+def test_forget_of_unknown_id_changes_nothing(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    accepted(dedupe, [10, 11])
+    version = dedupe.bots[BOT]["version"]
+    dedupe.forget(BOT, 50)
+    assert dedupe.bots[BOT]["version"] == version
+    assert not dedupe.accept(BOT, 11)
+
+
+def test_window_overflow_moves_floor_past_gap(backend):
+    dedupe = bot.UpdateDeduplicator(window=3)
+    assert accepted(dedupe, [100, 102, 103, 104]) == [100, 102, 103, 104]
+    assert dedupe.bots[BOT]["floor"] == 100
+    assert dedupe.accept(BOT, 106)
+    # Окно переполнено: 101 считается обработанным, пол догоняет цепочку 102..104
+    state = dedupe.bots[BOT]
+    assert (state["floor"], state["above"]) == (104, {106})
+    assert not dedupe.accept(BOT, 101)
+
+
+def test_reload_from_persisted_mark(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    accepted(dedupe, [10, 11, 13, 15])
+    dedupe.flush()
+    assert backend.get_update_mark()[0] == 11
+    assert backend.get_update_mark()[2] == [13, 15]
+
+    restarted = bot.UpdateDeduplicator(window=100)
+    assert accepted(restarted, [11, 12, 13, 14, 15, 16]) == [12, 14, 16]
+
+
+def test_persisted_mark_older_than_ttl_is_ignored(backend):
+    backend.update_mark = (11, time.time() - bot.DEDUPE_MARK_TTL - 1, [13])
+    dedupe = bot.UpdateDeduplicator(window=100)
+    # Telegram начал нумерацию заново: старая отметка не должна отбрасывать новые id
+    assert accepted(dedupe, [5, 6, 13]) == [5, 6, 13]
+
+
+def test_idle_longer_than_ttl_resets_state(backend):
+    dedupe = bot.UpdateDeduplicator(window=100)
+    accepted(dedupe, [10, 11])
+    dedupe.bots[BOT]["last"] -= bot.DEDUPE_MARK_TTL
+    assert accepted(dedupe, [3, 4]) == [3, 4]
+    assert dedupe.bots[BOT]["floor"] == 4
@@ -0,0 +1,41 @@
+import bot
+
+
+def test_parse_rate():
+    assert bot.parse_rate("3/60") == (3, 60.0)
+    assert bot.parse_rate(" 10/0.5") == (10, 0.5)
+
+
+def test_window_slides():
+    limiter = bot.SlidingWindowLimiter()
+    for now in (0, 1, 2):
+        assert not limiter.is_limited("k", 3, 10, now)
+        limiter.record("k", now)
+    assert limiter.is_limited("k", 3, 10, 9.9)
+    # Первая отметка (0) выпала из окна
+    assert not limiter.is_limited("k", 3, 10, 10)
+    limiter.record("k", 10)
+    assert limiter.is_limited("k", 3, 10, 10.5)
+    assert not limiter.is_limited("other", 3, 10, 10.5)
+
+
+def test_one_warning_per_window():
+    limiter = bot.SlidingWindowLimiter()
+    assert limiter.should_warn("k", 10, 0)
+    assert not limiter.should_warn("k", 10, 5)
+    assert not limiter.should_warn("k", 10, 9.9)
+    assert limiter.should_warn("k", 10, 10)
+    assert limiter.should_warn("other", 10, 10)
+
+
+def test_sweep_drops_idle_keys():
+    longest = max(window for _, window in [*bot.RATE_LIMITS.values(), bot.CHAT_RATE_LIMIT])
+    limiter = bot.SlidingWindowLimiter(sweep_every=3)
+    limiter.record("old", 0)
+    limiter.should_warn("old", 10, 0)
+    limiter.record("fresh", longest)
+    assert set(limiter.hits) == {"old", "fresh"}
+    # Третий вызов record запускает уборку
+    limiter.record("fresh", longest + 1)
+    assert set(limiter.hits) == {"fresh"}
+    assert limiter.warned_until == {}
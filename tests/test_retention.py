@@ -0,0 +1,35 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    backend = bot.SQLiteStorage(str(tmp_path / "test.db"))
+    backend.init()
+    monkeypatch.setitem(bot.storages, bot.DEFAULT_BOT_ID, backend)
+    return backend
+
+
+def test_stale_user_is_archived_with_quests_and_achievements(backend):
+    backend.create_user(1, 10)
+    backend.create_quest(1, 10, "have_child")
+    backend.complete_quest_db(1, 10, "have_child")
+    backend.create_user(2, 10)
+    backend.complete_quest_db(2, 10, "have_child")
+    conn = backend.connect()
+    conn.execute("UPDATE users SET created_at = '2000-01-01' WHERE user_id = 1")
+    conn.commit()
+    conn.close()
+
+    archived = []
+    moved = bot.run_in_batches(lambda c: bot.archive_stale_users(c, "2001-01-01", archived))
+    assert moved == 1
+    assert backend.get_user(1, 10) is None
+    assert backend.get_quests(1, 10) == []
+    assert backend.get_achievements(1, 10) == []
+    assert backend.get_achievements(2, 10) == ["parent"]
+
+    conn = backend.connect()
+    assert conn.execute("SELECT user_id, code FROM achievements_archive").fetchall() == [(1, "parent")]
+    conn.close()
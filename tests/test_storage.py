@@ -0,0 +1,141 @@
+"""Один и тот же сценарий через SQLiteStorage и MemoryStorage должен давать одинаковый результат:
+MemoryStorage повторяет то, что в SQLite делают триггеры (kids_count, уровень семьи, дневные сводки журнала)."""
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def make_storage(tmp_path):
+    saved = bot.storages[bot.DEFAULT_BOT_ID]
+
+    def make(kind: str) -> bot.Storage:
+        backend = bot.SQLiteStorage(str(tmp_path / "test.db")) if kind == "sqlite" else bot.MemoryStorage()
+        backend.init()
+        bot.storages[bot.DEFAULT_BOT_ID] = backend
+        bot.card_cache.clear()
+        return backend
+
+    yield make
+    bot.storages[bot.DEFAULT_BOT_ID] = saved
+    bot.card_cache.clear()
+
+
+def marriage_state(storage, user_id, chat_id):
+    marriage = storage.is_married(user_id, chat_id)
+    if marriage is None:
+        return None
+    # Без married_at и last_daily: время записи у бэкендов разное
+    user1, user2, _, budget, _, level, _, kids = marriage
+    return user1, user2, budget, level, kids
+
+
+def family_scenario(storage) -> list:
+    out = []
+    storage.register_marriage(1, 2, 10)
+    storage.register_marriage(3, 4, 10)
+    out.append(marriage_state(storage, 2, 10))
+
+    for user_id, amount, reason in [(1, 400, "salary"), (2, 700, "daily"), (1, -300, "casino"), (1, 200, "quest")]:
+        out.append(storage.update_family_budget(user_id, 10, amount, reason))
+    out.append(storage.update_family_budget(5, 10, 100, "salary"))
+    out.append(marriage_state(storage, 1, 10))
+
+    for name in ("A", "B", "C"):
+        out.append(storage.add_child(storage.is_married(1, 10), 10, name))
+    out.append((storage.count_children(1, 10), [c[0] for c in storage.get_children(2, 10)]))
+    out.append(marriage_state(storage, 1, 10))
+
+    storage.create_user(1, 10)
+    for quest_type in bot.QUESTS_INFO:
+        storage.create_quest(1, 10, quest_type)
+    storage.update_quest_progress(1, 10, "work_5_times", 3)
+    out.append(storage.complete_quest_db(1, 10, "have_child"))
+    out.append(storage.complete_quest_db(1, 10, "have_child"))
+    out.append(storage.get_quests(1, 10))
+
+    out.append(storage.buy_item(1, 10, "Повар"))
+    out.append(storage.buy_item(3, 10, "Повар"))
+    out.append(storage.get_user(1, 10)[0])
+
+    out.append(storage.get_history(1, 10, bot.HISTORY_DAYS))
+    out.append(storage.get_chat_economy(10, bot.HISTORY_DAYS))
+    out.append((sorted(storage.get_achievements(1, 10)), sorted(storage.get_achievements(2, 10))))
+
+    storage.divorce(2, 10)
+    out.append((marriage_state(storage, 1, 10), storage.count_children(1, 10)))
+    out.append(sorted(storage.get_achievements(1, 10)))
+    storage.reset_user(1, 10)
+    out.append((storage.get_user(1, 10), storage.get_quests(1, 10), storage.get_achievements(1, 10)))
+    out.append(marriage_state(storage, 3, 10))
+    return out
+
+
+def test_backends_agree_on_family_scenario(make_storage):
+    sqlite_result = family_scenario(make_storage("sqlite"))
+    memory_result = family_scenario(make_storage("memory"))
+    assert memory_result == sqlite_result
+
+
+def test_level_follows_budget_and_reports_level_up_once(make_storage):
+    for kind in ("sqlite", "memory"):
+        storage = make_storage(kind)
+        storage.register_marriage(1, 2, 10)
+        assert storage.update_family_budget(1, 10, 600, "salary")[:3] == (2, bot.family_level_title(2), True)
+        assert storage.update_family_budget(1, 10, -500, "casino")[:3] == (1, bot.family_level_title(1), False)
+        assert marriage_state(storage, 1, 10)[3] == 1
+        # Повторно набранный уровень — не повышение
+        assert storage.update_family_budget(1, 10, 500, "salary")[:3] == (2, bot.family_level_title(2), False)
+
+
+def test_budget_achievement_unlocks_once(make_storage):
+    for kind in ("sqlite", "memory"):
+        storage = make_storage(kind)
+        storage.register_marriage(1, 2, 10)
+        assert storage.update_family_budget(1, 10, 1000, "daily")[3] == ["rich"]
+        assert storage.update_family_budget(2, 10, 10, "daily")[3] == []
+        assert storage.get_achievements(2, 10) == ["rich"]
+
+
+def test_update_mark_roundtrip(make_storage):
+    for kind in ("sqlite", "memory"):
+        storage = make_storage(kind)
+        assert storage.get_update_mark() is None
+        storage.set_update_mark(41, [43, 45])
+        update_id, _, pending = storage.get_update_mark()
+        assert (update_id, pending) == (41, [43, 45])
+
+
+@pytest.mark.parametrize("moment", ["2024-02-29 10:00:00", "2023-12-31 23:59:59", "2025-06-15 00:00:00"])
+def test_one_year_later_matches_sqlite(moment):
+    expected = sqlite3.connect(":memory:").execute("SELECT datetime(?, '+1 year')", (moment,)).fetchone()[0]
+    assert bot.one_year_later(datetime.fromisoformat(moment)).strftime('%Y-%m-%d %H:%M:%S') == expected
+
+
+def test_child_birthday_is_one_year_after_birth(make_storage):
+    for kind in ("sqlite", "memory"):
+        storage = make_storage(kind)
+        storage.register_marriage(1, 2, 10)
+        storage.add_child(storage.is_married(1, 10), 10, "A")
+        _, created_at, birthday = storage.get_children(1, 10)[0]
+        assert birthday == bot.one_year_later(datetime.fromisoformat(created_at)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def test_legacy_marriages_rebuild_keeps_rejected_rows(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE marriages (user1 INTEGER, user2 INTEGER, chat_id INTEGER, "
+                 "married_at TEXT, budget INTEGER, last_daily TEXT)")
+    conn.executemany("INSERT INTO marriages VALUES (?, ?, ?, '2024-01-01 00:00:00', ?, NULL)",
+                     [(1, 2, 10, 500), (3, 3, 10, 70), (4, 5, None, 90)])
+    conn.commit()
+    conn.close()
+
+    bot.SQLiteStorage(path).init()
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT user1, user2, budget FROM marriages").fetchall() == [(1, 2, 500)]
+    assert conn.execute("SELECT user1, budget FROM marriages_rejected ORDER BY user1").fetchall() == [(3, 70), (4, 90)]
+    conn.close()